@@ -0,0 +1,72 @@
+import re
+import sqlite3
+import threading
+import pandas as pd
+import logging
+from typing import Iterator, Union
+from db.db_access import DEFAULT_CHUNKSIZE
+from benchmarks.synthetic_archive import report_rtf
+
+class LocalDatabaseAccess:
+    # SQLite stand-in for db.db_access.DatabaseAccess holding the
+    # CITAS_EXPLORACIONES and CITAS_INFORMES tables of a synthetic archive.
+    # It also counts the queries it receives.
+    def __init__(self, path: str = ':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.queries = 0
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS CITAS_EXPLORACIONES ("
+                               "AANN_Externo TEXT, IDCita INTEGER)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS CITAS_INFORMES ("
+                               "IDCita INTEGER, Numero INTEGER, InformeRTF TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_exploraciones "
+                               "ON CITAS_EXPLORACIONES (AANN_Externo)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_informes "
+                               "ON CITAS_INFORMES (IDCita)")
+
+    def populate(self, archive: dict, report_paragraphs: int = 40) -> None:
+        studies = archive['studies']
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO CITAS_EXPLORACIONES VALUES (?, ?)",
+                                   [(s['accession'], s['id_date']) for s in studies])
+            self._conn.executemany("INSERT INTO CITAS_INFORMES VALUES (?, 1, ?)",
+                                   [(s['id_date'], report_rtf(s['patient'], report_paragraphs))
+                                    for s in studies])
+
+    @staticmethod
+    def _translate(query: str) -> str:
+        # T-SQL and pymssql placeholders to SQLite
+        query = query.replace('%s', '?')
+        top = re.search(r'SELECT\s+TOP\s+(\d+)\s+', query, flags=re.IGNORECASE)
+        if top:
+            query = query[:top.start()] + 'SELECT ' + query[top.end():] + f' LIMIT {top.group(1)}'
+        return query
+
+    def run_query(self, query: str,
+                  params: Union[tuple, dict, None] = None,
+                  verbose: bool = False) -> pd.DataFrame:
+        return pd.concat(list(self.iter_query(query, params)) or [pd.DataFrame()],
+                         ignore_index=True)
+
+    def iter_query(self, query: str,
+                   params: Union[tuple, dict, None] = None,
+                   chunksize: int = DEFAULT_CHUNKSIZE,
+                   verbose: bool = False) -> Iterator[pd.DataFrame]:
+        with self._lock:
+            self.queries += 1
+            try:
+                cursor = self._conn.execute(self._translate(query), params or ())
+                columns = [c[0] for c in cursor.description]
+                chunks = list()
+                rows = cursor.fetchmany(chunksize)
+                while rows:
+                    chunks.append(pd.DataFrame.from_records(rows, columns=columns))
+                    rows = cursor.fetchmany(chunksize)
+            except Exception as err:
+                logging.error(f'CONNECTION FAILED: {err}')
+                return
+        yield from chunks
+
+    def close(self) -> None:
+        self._conn.close()
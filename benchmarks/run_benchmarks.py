@@ -0,0 +1,115 @@
+from argparse import ArgumentParser
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import tempfile
+import platform
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.convert_to_nifti import convert2nifti, ConversionStatus
+from src.extract_metadata import extract_metadata
+from src.extract_forms import extract_forms, FormStatus
+from src.paths import add_output_paths, create_directory_structure
+from benchmarks.synthetic_archive import generate_archive
+from benchmarks.local_db import LocalDatabaseAccess
+
+
+def timed(func, *args, **kwargs) -> tuple:
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    return result, {'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu}
+
+def manage_arguments():
+    parser = ArgumentParser(description='Benchmark the preprocessing stages on a synthetic archive')
+    parser.add_argument('--patients', type=int, default=4)
+    parser.add_argument('--studies_per_patient', type=int, default=1)
+    parser.add_argument('--series_per_study', type=int, default=3)
+    parser.add_argument('--slices', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=64)
+    parser.add_argument('--columns', type=int, default=64)
+    parser.add_argument('--private_block_kb', type=int, default=0,
+                        help='Size of a private vendor block added to every header')
+    parser.add_argument('--scan_workers', type=int, default=1)
+    parser.add_argument('--form_workers', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Repetitions of every stage, output files are removed in between')
+    parser.add_argument('--work_directory', type=str, default=None,
+                        help='Directory for the archive and outputs (temporary if not given)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file for the results (stdout if not given)')
+    return parser.parse_args()
+
+def run(args) -> dict:
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='preprocessing_bench_')
+    input_directory = os.path.join(work_directory, 'input')
+    output_directory = os.path.join(work_directory, 'output')
+
+    archive, generation = timed(generate_archive, input_directory,
+                                patients=args.patients,
+                                studies_per_patient=args.studies_per_patient,
+                                series_per_study=args.series_per_study,
+                                slices=args.slices,
+                                rows=args.rows,
+                                columns=args.columns,
+                                private_block_bytes=args.private_block_kb * 1024)
+    db_access = LocalDatabaseAccess()
+    db_access.populate(archive)
+    series = glob.glob(os.path.join(input_directory, '*', '*'))
+
+    stages = {'extract_metadata': list(), 'extract_forms': list(), 'convert2nifti': list()}
+    for _ in range(args.repeat):
+        shutil.rmtree(output_directory, ignore_errors=True)
+        os.makedirs(output_directory)
+
+        db_access.queries = 0
+        df, timing = timed(extract_metadata, series, db_access, workers=args.scan_workers)
+        timing['db_queries'] = db_access.queries
+        stages['extract_metadata'].append(timing)
+
+        add_output_paths(df, output_directory)
+        create_directory_structure(df)
+
+        db_access.queries = 0
+        forms, timing = timed(extract_forms, df, db_access, workers=args.form_workers)
+        timing['db_queries'] = db_access.queries
+        timing['written'] = sum(s == FormStatus.OK for s in forms.values())
+        stages['extract_forms'].append(timing)
+
+        results, timing = timed(convert2nifti, df, workers=args.workers)
+        timing['converted'] = sum(r.status == ConversionStatus.OK for r in results)
+        timing['failed'] = sum(r.status == ConversionStatus.FAILED for r in results)
+        stages['convert2nifti'].append(timing)
+
+    summary = dict()
+    for stage, runs in stages.items():
+        walls = sorted(r['wall_s'] for r in runs)
+        summary[stage] = {'runs': runs,
+                          'best_wall_s': walls[0],
+                          'median_wall_s': walls[len(walls) // 2],
+                          'series_per_s': len(series) / walls[0] if walls[0] else None}
+
+    if args.work_directory is None:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return {'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'parameters': {k: v for k, v in vars(args).items() if k not in ('output', 'work_directory')},
+            'archive': {'series': len(series), 'studies': len(archive['studies']),
+                        'generation_s': generation['wall_s']},
+            'stages': summary}
+
+if __name__ == "__main__":
+    args = manage_arguments()
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
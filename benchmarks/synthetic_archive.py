@@ -0,0 +1,124 @@
+import os
+import datetime
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+# Orientation (ImageOrientationPatient) and slice direction of each plane
+PLANES = {'Axial': ([1, 0, 0, 0, 1, 0], [0, 0, 1]),
+          'Sagittal': ([0, 1, 0, 0, 0, -1], [1, 0, 0]),
+          'Coronal': ([1, 0, 0, 0, 0, -1], [0, 1, 0])}
+
+SEQUENCES = [('T1_MPRAGE', 2300.0, 2.98, 900.0),
+             ('T2_TSE', 5000.0, 98.0, None),
+             ('FLAIR', 9000.0, 81.0, 2500.0),
+             ('DWI', 4800.0, 89.0, None)]
+
+RTF_TEMPLATE = ("{{\\rtf1\\ansi\\deff0 {{\\fonttbl {{\\f0 Arial;}}}}"
+                "\\f0\\fs20 Paciente: PACIENTE {patient}\\par "
+                "Solicitado por: Dr. Solicitante\\par "
+                "{body}}}")
+
+def accession_number(id_date: int, external: bool) -> str:
+    # Regular accession numbers carry the IDCita, external ones need a DB lookup
+    return f'EXT{id_date:08d}' if external else f'1.{id_date}.1.1'
+
+def report_rtf(patient: int, paragraphs: int = 40) -> str:
+    body = ''.join(f'Hallazgo {i}: sin alteraciones significativas en la secuencia.\\par '
+                   for i in range(paragraphs))
+    return RTF_TEMPLATE.format(patient=patient, body=body)
+
+def write_series(series_dir: str, patient_id: str, study: dict, series_number: int,
+                 slices: int, rows: int, columns: int, plane: str,
+                 private_block_bytes: int = 0) -> None:
+    os.makedirs(series_dir, exist_ok=True)
+    iop, normal = PLANES[plane]
+    description, tr, te, ti = SEQUENCES[series_number % len(SEQUENCES)]
+    series_uid = generate_uid()
+    spacing = 1.0
+    thickness = 3.0
+    for k in range(slices):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.Modality = 'MR'
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+        ds.PatientID = patient_id
+        ds.PatientName = f'SYNTHETIC^{patient_id}'
+        ds.PatientSex = 'F' if int(patient_id[3:]) % 2 else 'M'
+        ds.PatientBirthDate = '19700101'
+        ds.StudyID = str(study['number'])
+        ds.StudyInstanceUID = study['uid']
+        ds.StudyDate = study['date']
+        ds.AccessionNumber = study['accession']
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = series_number
+        ds.SeriesDescription = description
+        ds.InstanceNumber = k + 1
+        ds.Manufacturer = 'SIEMENS'
+        ds.ManufacturerModelName = 'Prisma'
+        ds.MagneticFieldStrength = 3
+        ds.MRAcquisitionType = '2D'
+        ds.RepetitionTime = tr
+        ds.EchoTime = te
+        if ti is not None:
+            ds.InversionTime = ti
+        ds.SliceThickness = thickness
+        ds.SpacingBetweenSlices = thickness
+        ds.ImageOrientationPatient = iop
+        ds.ImagePositionPatient = [float(-100 + k * thickness * n) for n in normal]
+        ds.SliceLocation = k * thickness
+        ds.PixelSpacing = [spacing, spacing]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        if private_block_bytes:
+            # Stands in for the large Siemens CSA headers
+            block = ds.private_block(0x0029, 'SIEMENS CSA HEADER', create=True)
+            block.add_new(0x10, 'OB', os.urandom(private_block_bytes))
+        ds.PixelData = np.random.randint(0, 4096, (rows, columns), dtype=np.uint16).tobytes()
+        ds.save_as(os.path.join(series_dir, f'IM{k:05d}.dcm'), enforce_file_format=True)
+
+def generate_archive(root: str,
+                     patients: int = 4,
+                     studies_per_patient: int = 1,
+                     series_per_study: int = 3,
+                     slices: int = 20,
+                     rows: int = 64,
+                     columns: int = 64,
+                     external_fraction: float = 0.25,
+                     private_block_bytes: int = 0,
+                     seed: int = 0) -> dict:
+    # Builds root/<study>/<series>/*.dcm like the PACS export read by main.py.
+    # Returns the accession numbers and reports the local DB needs.
+    rng = np.random.default_rng(seed)
+    studies = list()
+    id_date = 100000
+    for p in range(patients):
+        patient_id = f'PAT{p:06d}'
+        for s in range(studies_per_patient):
+            id_date += 1
+            date = datetime.date(2018, 1, 1) + datetime.timedelta(days=int(rng.integers(0, 1500)))
+            study = {'uid': generate_uid(),
+                     'number': s + 1,
+                     'date': date.strftime('%Y%m%d'),
+                     'id_date': id_date,
+                     'patient': p,
+                     'accession': accession_number(id_date, rng.random() < external_fraction)}
+            study_dir = os.path.join(root, f'{patient_id}_{s:03d}')
+            for n in range(series_per_study):
+                plane = list(PLANES)[n % len(PLANES)]
+                write_series(os.path.join(study_dir, f'SER{n:03d}'), patient_id, study, n,
+                             slices, rows, columns, plane, private_block_bytes)
+            studies.append(study)
+    return {'studies': studies}
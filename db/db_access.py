@@ -1,6 +1,14 @@
 import pandas as pd
 import pymssql
 import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CHUNKSIZE = 1000
 
 class DatabaseAccess:
     def __init__(self, **params):
@@ -8,22 +16,110 @@ class DatabaseAccess:
         self.db = params["db"]
         self.user = params["usr"]
         self.pwd = params["pwd"]
+        self.pool_size = params.get("pool_size", DEFAULT_POOL_SIZE)
+        # Optional src.instrumentation.RunMetrics receiving query counts and latencies
+        self.metrics = params.get("metrics")
+        self._pool = queue.LifoQueue(maxsize=self.pool_size)
+        self._created = 0
+        # Notified when a connection is returned or discarded, i.e. a slot frees up
+        self._available = threading.Condition()
+
+    def _connect(self):
+        return pymssql.connect(self.ip,
+                               self.user,
+                               self.pwd,
+                               self.db)
+
+    def _acquire(self):
+        # An idle connection, or a new one while the pool is not full. Otherwise
+        # waits until a connection is returned or discarded.
+        with self._available:
+            while True:
+                try:
+                    return self._pool.get_nowait()
+                except queue.Empty:
+                    pass
+                if self._created < self.pool_size:
+                    self._created += 1
+                    break
+                self._available.wait()
+        try:
+            return self._connect()
+        except Exception:
+            self._release_slot()
+            raise
 
-    def run_query(self, query: str, verbose: bool = False)-> pd.DataFrame:
+    def _release_slot(self) -> None:
+        with self._available:
+            self._created -= 1
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            # Do not hand a possibly broken or half-read connection to the next caller
+            self._discard(conn)
+            raise
+        else:
+            with self._available:
+                self._pool.put(conn)
+                self._available.notify()
+
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._release_slot()
+
+    def _record(self, seconds: float) -> None:
+        if self.metrics is not None:
+            self.metrics.count('db_queries')
+            self.metrics.observe('db_query_seconds', seconds)
+
+    def run_query(self, query: str,
+                  params: Union[tuple, dict, None] = None,
+                  verbose: bool = False)-> pd.DataFrame:
         df_result = pd.DataFrame()
-        conn = None
         try:
-            conn = pymssql.connect(self.ip,
-                                   self.user,
-                                   self.pwd,
-                                   self.db)
-            if (verbose):
-                logging.ingo(f"Query executed {query}")
-            df_result = pd.read_sql_query(query, conn)
+            with self.connection() as conn:
+                if (verbose):
+                    logging.info(f"Query executed {query}")
+                start = time.perf_counter()
+                df_result = pd.read_sql_query(query, conn, params=params)
+                self._record(time.perf_counter() - start)
         except Exception as err:
             logging.error(f'CONNECTION FAILED: {err}')
-            conn = None
-        finally:
-            if conn != None:
-                conn.close()
         return(df_result)
+
+    def iter_query(self, query: str,
+                   params: Union[tuple, dict, None] = None,
+                   chunksize: int = DEFAULT_CHUNKSIZE,
+                   verbose: bool = False) -> Iterator[pd.DataFrame]:
+        try:
+            with self.connection() as conn:
+                if (verbose):
+                    logging.info(f"Query executed {query}")
+                start = time.perf_counter()
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                self._record(time.perf_counter() - start)
+                columns = [c[0] for c in cursor.description]
+                rows = cursor.fetchmany(chunksize)
+                while rows:
+                    yield pd.DataFrame.from_records(rows, columns=columns)
+                    rows = cursor.fetchmany(chunksize)
+                cursor.close()
+        except Exception as err:
+            logging.error(f'CONNECTION FAILED: {err}')
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
@@ -0,0 +1,32 @@
+import sqlite3
+import threading
+
+class IdDateCache:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS id_date ("
+                               "accession_number TEXT PRIMARY KEY, "
+                               "id_date INTEGER)")
+
+    def get_many(self, acc_nums: list) -> dict:
+        found = dict()
+        with self._lock:
+            for s in range(0, len(acc_nums), 500):
+                chunk = acc_nums[s: s + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute("SELECT accession_number, id_date FROM id_date "
+                                          f"WHERE accession_number IN ({placeholders})",
+                                          chunk)
+                found.update(rows.fetchall())
+        return found
+
+    def put_many(self, id_dates: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO id_date VALUES (?, ?)",
+                                   id_dates.items())
+
+    def close(self) -> None:
+        self._conn.close()
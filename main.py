@@ -2,32 +2,52 @@ from argparse import ArgumentParser
 import os
 import glob
 import logging
-import pandas as pd
 import json
-from src.convert_to_nifti import convert2nifti
+import re
+import signal
+from concurrent.futures import Executor
+from typing import Callable, Union
+from src.convert_to_nifti import convert2nifti, ConversionStatus, remove_stale_outputs
 from src.extract_metadata import extract_metadata
-from src.extract_forms import extract_forms
+from src.extract_forms import (extract_forms, export_forms, form_paths, FormStatus,
+                               compile_anonymization_patterns)
 from db.db_access import DatabaseAccess
+from db.id_date_cache import IdDateCache
+from src.manifest import ProcessingManifest, SeriesState, series_fingerprint, mark_converted
+from src.paths import add_output_paths, create_directory_structure
+from src.dedup import DuplicateIndex, mark_duplicates
+from src.nifti_output import NiftiFormat, DEFAULT_COMPRESSION_LEVEL
+from src.metadata_store import MetadataFormat, metadata_path, load_metadata, save_metadata
+from src.pipeline import PipelineConfig, run_pipeline
+from src.instrumentation import RunMetrics
+from src.pseudonyms import PseudonymIndex
+from src.sharding import parse_shard, shard_file, select_shard
+from src.process_pool import ProcessPool
+from src.watch import SeriesWatcher, DEFAULT_SETTLE_SECONDS, DEFAULT_POLL_SECONDS
 
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 LOG_FILE = "logging/preprocessing.log"
+RUN_SUMMARY_FILE = 'run_summary.json'
+PSEUDONYMS_FILE = 'pseudonyms.sqlite'
+LEGACY_PSEUDONYMS_FILE = 'pseudonyms.json'
 
-def create_directory_structure(df: pd.DataFrame) -> None:
-    nifti_paths = set(df['NiftiPath'])
-    report_paths = set(df['FormPath'])
-    for npath in (nifti_paths):
-        npath ='/'.join(npath.split("/")[:-1])
-        try:
-            os.makedirs(npath)
-        except:
-            continue
-    for rpath in (report_paths):
-        rpath = rpath ='/'.join(rpath.split("/")[:-1])
-        try:
-            os.makedirs(rpath)
-        except:
-            continue
+def previous_patient_ids(output_directory: str, metadata_format: MetadataFormat) -> dict:
+    # Subjects assigned before the pseudonym index existed
+    legacy_file = os.path.join(output_directory, LEGACY_PSEUDONYMS_FILE)
+    if os.path.exists(legacy_file):
+        with open(legacy_file, 'r') as f:
+            return json.load(f)
+    # Read as text, numeric patient ids keep their leading zeros
+    df = load_metadata(metadata_path(output_directory, metadata_format), metadata_format,
+                       columns=['OriginalPatientId', 'PatientID'])
+    df = df.dropna().astype(str).drop_duplicates()
+    conflicts = df['OriginalPatientId'].duplicated(keep=False)
+    if conflicts.any():
+        logging.error(f'{df.loc[conflicts, "OriginalPatientId"].nunique()} PATIENTS WITH MORE THAN ONE '
+                      'PATIENTID IN THE METADATA, THE FIRST ONE IS KEPT')
+    df = df.drop_duplicates(subset='OriginalPatientId')
+    return dict(zip(df['OriginalPatientId'], df['PatientID']))
 
 
 def manage_arguments():
@@ -45,6 +65,99 @@ def manage_arguments():
                         required=True,
                         metavar='-o',
                         default='')
+
+    parser.add_argument('--scan_workers',
+                        help='Number of threads used to read DICOM headers',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--form_workers',
+                        help='Number of threads used to write reports',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--anonymize_workers',
+                        help='Number of processes used to convert and anonymize reports',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--workers',
+                        help='Number of processes used for nifti conversion',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--native',
+                        help='Convert simple single-frame 3D series with the built-in NumPy/nibabel converter',
+                        action='store_true')
+
+    parser.add_argument('--nifti_format',
+                        help='nii.gz, or nii for uncompressed images that can be memory-mapped',
+                        choices=[f.value for f in NiftiFormat],
+                        default=NiftiFormat.NII_GZ.value)
+
+    parser.add_argument('--compression_level',
+                        help='gzip level (1-9) of nii.gz images',
+                        type=int,
+                        choices=range(1, 10),
+                        default=DEFAULT_COMPRESSION_LEVEL)
+
+    parser.add_argument('--compression_threads',
+                        help='Threads compressing each nii.gz image, per conversion process',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--retry_failed',
+                        help='Convert again series that failed before even if their files did not change',
+                        action='store_true')
+
+    parser.add_argument('--max_inflight_mb',
+                        help='Maximum size of DICOM data being converted at the same time',
+                        type=int,
+                        default=4096)
+
+    parser.add_argument('--metadata_format',
+                        help='Format of the metadata output',
+                        type=str,
+                        choices=[f.value for f in MetadataFormat],
+                        default=MetadataFormat.CSV.value)
+
+    parser.add_argument('--streaming',
+                        help='Overlap scanning, DB lookups, report export and conversion',
+                        action='store_true')
+
+    parser.add_argument('--batch_size',
+                        help='Series per batch in streaming mode',
+                        type=int,
+                        default=100)
+
+    parser.add_argument('--shard',
+                        help='Process only shard i of N (0 <= i < N), e.g. 0/4. Merge with merge_shards.py',
+                        type=parse_shard,
+                        default=None)
+
+    parser.add_argument('--prometheus_textfile',
+                        help='Write run metrics to this Prometheus textfile',
+                        type=str,
+                        default=None)
+
+    parser.add_argument('--profile_stage',
+                        help='Profile a stage with cProfile, the .prof file goes to the output directory',
+                        action='append',
+                        default=[])
+
+    parser.add_argument('--watch',
+                        help='Keep running and process new series as they appear in the input directory',
+                        action='store_true')
+
+    parser.add_argument('--settle_seconds',
+                        help='Watch mode: seconds without changes before a new series is processed',
+                        type=float,
+                        default=DEFAULT_SETTLE_SECONDS)
+
+    parser.add_argument('--poll_seconds',
+                        help='Watch mode: seconds between checks for new series',
+                        type=float,
+                        default=DEFAULT_POLL_SECONDS)
     
     return parser.parse_args()
 
@@ -58,55 +171,249 @@ def main(args):
     
     assert os.path.exists(input_directory)
     assert os.path.exists(output_directory)
-    ouput_file = os.path.join(output_directory, 'metadata.csv')
-    original_series = glob.glob(os.path.join(input_directory, '*','*'))
+    metadata_format = MetadataFormat(args.metadata_format)
+    ouput_file = metadata_path(output_directory, metadata_format, args.shard)
+    id_date_cache_file = os.path.join(output_directory, shard_file('id_date_cache.sqlite', args.shard))
+    manifest_file = os.path.join(output_directory, shard_file('manifest.sqlite', args.shard))
+    original_series = sorted(glob.glob(os.path.join(input_directory, '*','*')))
+    if args.shard is not None:
+        original_series = select_shard(original_series, args.shard)
+
+    # Subjects are shared by all runs and shards writing to this output directory
+    pseudonyms = PseudonymIndex(os.path.join(output_directory, PSEUDONYMS_FILE))
+    if pseudonyms.empty():
+        pseudonyms.seed(previous_patient_ids(output_directory, metadata_format))
+
+    metrics = RunMetrics(profile_stages=args.profile_stage, profile_dir=output_directory)
+
+    def write_metrics():
+        metrics.write_json(os.path.join(output_directory, shard_file(RUN_SUMMARY_FILE, args.shard)))
+        if args.prometheus_textfile:
+            metrics.write_prometheus(args.prometheus_textfile)
+
+    try:
+        run(args, original_series, ouput_file, metadata_format,
+            id_date_cache_file, manifest_file, pseudonyms, metrics, write_metrics)
+    finally:
+        write_metrics()
+        pseudonyms.close()
+
+def run(args, original_series: list, ouput_file: str, metadata_format: MetadataFormat,
+        id_date_cache_file: str, manifest_file: str, pseudonyms: PseudonymIndex,
+        metrics: RunMetrics, write_metrics: Union[Callable, None] = None) -> None:
+    manifest = ProcessingManifest(manifest_file)
 
     with open('config.json', 'r') as f:
         config = json.load(f)
 
-    irix_access = DatabaseAccess(**config['Database_params_Irix'])
-    forms_access = DatabaseAccess(**config['Database_params_IrixInformes'])
+    irix_access = DatabaseAccess(metrics=metrics, **config['Database_params_Irix'])
+    forms_access = DatabaseAccess(metrics=metrics, **config['Database_params_IrixInformes'])
+    anonymization_pattern = compile_anonymization_patterns(config.get('Anonymization_patterns'))
     
+    id_date_cache = IdDateCache(id_date_cache_file)
+    duplicates = DuplicateIndex()
+    duplicates.seed(manifest.series_uids())
+
+    # In watch mode the worker pools stay up between batches, like the DB connections
+    executor, anonymizer = None, None
+    if args.watch:
+        executor = ProcessPool(max_workers=max(1, args.workers))
+        if args.anonymize_workers > 1:
+            anonymizer = ProcessPool(max_workers=args.anonymize_workers)
+
+    def process_batch(series: list) -> None:
+        try:
+            process(args, series, ouput_file, metadata_format, manifest, irix_access, forms_access,
+                    anonymization_pattern, id_date_cache, pseudonyms, metrics, executor, anonymizer,
+                    duplicates)
+        finally:
+            # A worker that died breaks its pool; the next batch gets a new one
+            for pool in (executor, anonymizer):
+                if pool is not None and pool.broken:
+                    pool.restart()
+
+    try:
+        if not args.watch:
+            process_batch(original_series)
+            return
+        # Started before the first pass so series arriving meanwhile are not missed
+        watcher = SeriesWatcher(args.input_directory, args.settle_seconds, args.poll_seconds)
+        try:
+            process_batch(original_series)
+            watch(args, watcher, process_batch, write_metrics)
+        finally:
+            watcher.close()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if anonymizer is not None:
+            anonymizer.shutdown()
+        id_date_cache.close()
+        manifest.close()
+        irix_access.close()
+        forms_access.close()
+
+def watch(args, watcher: SeriesWatcher, process_batch: Callable,
+          write_metrics: Union[Callable, None] = None) -> None:
+    # Runs until interrupted (Ctrl-C or SIGTERM)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.info(f'Watching {args.input_directory} for new series ({watcher.mode})')
+    try:
+        while True:
+            series = watcher.poll()
+            if args.shard is not None:
+                series = select_shard(series, args.shard)
+            if not series:
+                continue
+            logging.info(f'{len(series)} new series ready')
+            try:
+                process_batch(series)
+            except Exception as err:
+                logging.error(f'ERROR PROCESSING {len(series)} NEW SERIES; ERROR {err}')
+            if write_metrics is not None:
+                write_metrics()
+    except KeyboardInterrupt:
+        logging.info('Watch mode stopped')
+
+def process(args, original_series: list, ouput_file: str, metadata_format: MetadataFormat,
+            manifest: ProcessingManifest, irix_access: DatabaseAccess, forms_access: DatabaseAccess,
+            anonymization_pattern: re.Pattern, id_date_cache: IdDateCache, pseudonyms: PseudonymIndex,
+            metrics: RunMetrics, executor: Union[Executor, None] = None,
+            anonymizer: Union[Executor, None] = None,
+            duplicates: Union[DuplicateIndex, None] = None) -> None:
+    output_directory = args.output_directory
+    duplicates = duplicates if duplicates is not None else DuplicateIndex()
+
+    # Only new series or series whose files changed since they were processed
+    with metrics.stage('manifest'):
+        fingerprints = {s: series_fingerprint(s) for s in original_series}
+        pending_series = manifest.pending(fingerprints, retry_failed=args.retry_failed)
+        known_failures = [] if args.retry_failed else manifest.failed(fingerprints)
+        changed = set(manifest.changed({s: fingerprints[s] for s in pending_series}))
+    metrics.count('series_found', len(original_series))
+    metrics.count('series_known_failed', len(known_failures))
+    if known_failures:
+        logging.info(f'{len(known_failures)} series skipped, they failed before and their files did not change')
+    metrics.count('series_pending', len(pending_series))
+    metrics.count('series_changed', len(changed))
+    logging.info(f'{len(pending_series)} of {len(original_series)} series pending, {len(changed)} modified since processed')
+
+    # Reports that were missing or could not be written in earlier runs
+    retry = manifest.forms_to_retry()
+    if retry:
+        with metrics.stage('retry_forms'):
+            statuses = export_forms(retry, forms_access,
+                                    workers=args.form_workers,
+                                    pattern=anonymization_pattern,
+                                    anonymize_workers=args.anonymize_workers,
+                                    anonymizer=anonymizer)
+        manifest.mark_forms(statuses, retry)
+        metrics.record_forms(statuses)
+        recovered = sum(1 for r in statuses.values() if r in (FormStatus.OK, FormStatus.SKIPPED))
+        logging.info(f'{recovered} of {len(retry)} reports missing in earlier runs exported')
+
+    if args.streaming:
+        pipeline_config = PipelineConfig(output_directory=output_directory,
+                                         metadata_file=ouput_file,
+                                         metadata_format=metadata_format,
+                                         scan_workers=args.scan_workers,
+                                         form_workers=args.form_workers,
+                                         anonymize_workers=args.anonymize_workers,
+                                         anonymization_pattern=anonymization_pattern,
+                                         workers=args.workers,
+                                         max_inflight_bytes=args.max_inflight_mb * 1024 ** 2,
+                                         native=args.native,
+                                         nifti_format=NiftiFormat(args.nifti_format),
+                                         compression_level=args.compression_level,
+                                         compression_threads=args.compression_threads,
+                                         batch_size=args.batch_size)
+        with metrics.stage('pipeline'):
+            counts = run_pipeline(pending_series, pipeline_config, irix_access, forms_access,
+                                  manifest, fingerprints, id_date_cache,
+                                  pseudonyms, metrics, executor, anonymizer, duplicates, changed)
+        logging.info(f'Streaming run finished: {dict(counts)}')
+        if counts[ConversionStatus.FAILED.value]:
+            logging.error(f'Error while converting {counts[ConversionStatus.FAILED.value]} series to nifti. Check log.')
+        return
+
     # Extract and save metadata
-    df = extract_metadata(original_series, irix_access)
-
-    # Generate nifti and report paths
-    df['NiftiPath'] = df.apply(lambda x: os.path.join(output_directory,
-                                                      str(x['PatientID']),
-                                                      str(x['StudyDate'].date()),
-                                                      str(x['StudyInstanceUID']),
-                                                      str(x['SeriesInstanceUID']) + '.nii.gz'),
-                                axis=1              
-                              )
-
-    df['FormPath'] = df.apply(lambda x: os.path.join(output_directory,
-                                                     str(x['PatientID']),
-                                                     str(x['StudyDate'].date()),
-                                                     'Report',
-                                                     str(x['DateID']) + '.txt'),
-                                axis=1
-                               )
-    # Output csv with metadata
-    df.to_csv(ouput_file, index=False)
-
-    # Create directory structure
-    create_directory_structure(df)
+    with metrics.stage('extract_metadata'):
+        df = extract_metadata(pending_series, irix_access, id_date_cache,
+                              workers=args.scan_workers,
+                              pseudonyms=pseudonyms,
+                              metrics=metrics)
+    metrics.count('series_scanned', len(df))
+    if df.empty:
+        logging.info('No new or modified series to process')
+        return
+
+    # Copies of the same series exported more than once are converted once
+    with metrics.stage('deduplicate'):
+        mark_duplicates(df, duplicates, workers=args.scan_workers)
+    n_duplicates = int(df['DuplicateOf'].notna().sum())
+    if n_duplicates:
+        logging.info(f'{n_duplicates} series are copies of another series and will not be converted')
+
+    with metrics.stage('save_metadata'):
+        # Generate nifti and report paths
+        add_output_paths(df, output_directory, NiftiFormat(args.nifti_format))
+
+        # Old outputs of modified series go before the manifest forgets their fingerprint
+        remove_stale_outputs(df, changed)
+
+        # Output metadata, merged with the rows of previous runs
+        save_metadata(df, ouput_file, metadata_format, replaced_series=pending_series)
+        manifest.mark_many([(s, fingerprints[s], u) for s, u in zip(df['OriginalSeriesDir'],
+                                                                    df['SeriesInstanceUID'])],
+                           SeriesState.SCANNED)
+
+        # Create directory structure
+        create_directory_structure(df)
 
     # Extract reports
-    result_form_extraction = extract_forms(df, forms_access)
-    if(result_form_extraction):
+    with metrics.stage('extract_forms'):
+        result_form_extraction = extract_forms(df, forms_access,
+                                               workers=args.form_workers,
+                                               pattern=anonymization_pattern,
+                                               anonymize_workers=args.anonymize_workers,
+                                               anonymizer=anonymizer,
+                                               refresh=set(df.loc[df['OriginalSeriesDir'].isin(changed), 'DateID']))
+    manifest.mark_forms(result_form_extraction, form_paths(df))
+    metrics.record_forms(result_form_extraction)
+    failed_forms = [d for d, r in result_form_extraction.items() if r == FormStatus.FAILED]
+    missing_forms = [d for d, r in result_form_extraction.items() if r == FormStatus.MISSING]
+    if missing_forms:
+        logging.warning(f'No form found for {len(missing_forms)} DateIDs')
+    if(not failed_forms):
         logging.info('Form extraction successfully done')
     else:
-        logging.error('Error while extracting forms. Check log.')
+        logging.error(f'Error while extracting {len(failed_forms)} forms. Check log.')
 
 
     # Convert images to nifti
-    result_nifit_conversion = convert2nifti(df)
-    if(result_nifit_conversion):
+    def on_result(result):
+        metrics.record_conversion(result)
+        mark_converted(manifest, fingerprints, result)
+
+    with metrics.stage('convert2nifti'):
+        result_nifit_conversion = convert2nifti(df,
+                                                workers=args.workers,
+                                                max_inflight_bytes=args.max_inflight_mb * 1024 ** 2,
+                                                on_result=on_result,
+                                                executor=executor,
+                                                native=args.native,
+                                                compression_level=args.compression_level,
+                                                compression_threads=args.compression_threads)
+    failed = [r for r in result_nifit_conversion if r.status == ConversionStatus.FAILED]
+    converted = [r for r in result_nifit_conversion if r.status == ConversionStatus.OK]
+    rejected = [r for r in result_nifit_conversion if r.status == ConversionStatus.REJECTED]
+    logging.info(f'{len(converted)} series converted to nifti')
+    if rejected:
+        logging.warning(f'{len(rejected)} series rejected by the pre-flight checks')
+    if(not failed):
         logging.info('Nifti conversion successfully done')
     else:
-        logging.error('Error while converting to nifti. Check log.')
-
+        logging.error(f'Error while converting {len(failed)} series to nifti. Check log.')
 
 if __name__ == "__main__":
     args = manage_arguments()
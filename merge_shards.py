@@ -0,0 +1,73 @@
+from argparse import ArgumentParser
+import os
+import shutil
+import logging
+import pandas as pd
+from src.metadata_store import MetadataFormat, metadata_path, load_metadata, append_parquet
+
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FILE = "logging/preprocessing.log"
+
+def manage_arguments():
+    parser = ArgumentParser(description='Merge the metadata written by main.py --shard i/N')
+    parser.add_argument('--output_directory',
+                        help='Output directory shared by the shards',
+                        type=str,
+                        required=True,
+                        metavar='-o')
+
+    parser.add_argument('--shards',
+                        help='Number of shards N the archive was split into',
+                        type=int,
+                        required=True)
+
+    parser.add_argument('--metadata_format',
+                        help='Format of the shard and merged metadata',
+                        type=str,
+                        choices=[f.value for f in MetadataFormat],
+                        default=MetadataFormat.CSV.value)
+    return parser.parse_args()
+
+def merge_shards(output_directory: str, shards: int, metadata_format: MetadataFormat) -> pd.DataFrame:
+    frames = list()
+    for index in range(shards):
+        path = metadata_path(output_directory, metadata_format, (index, shards))
+        if not os.path.exists(path):
+            logging.error(f'MISSING METADATA FOR SHARD {index}/{shards}: {path}')
+            continue
+        frames.append(load_metadata(path, metadata_format))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if df.empty:
+        return df
+
+    # Deterministic result whatever the order the shards finished in
+    df = df.drop_duplicates(subset='OriginalSeriesDir', keep='last') \
+           .sort_values('OriginalSeriesDir') \
+           .reset_index(drop=True)
+    subjects = df.groupby('OriginalPatientId')['PatientID'].nunique()
+    if (subjects > 1).any():
+        logging.error(f'{int((subjects > 1).sum())} PATIENTS WITH MORE THAN ONE PATIENTID ACROSS SHARDS')
+    return df
+
+def main(args):
+    logging.basicConfig(level=logging.DEBUG,
+                        filename=LOG_FILE,
+                        filemode='a',
+                        format=LOG_FORMAT)
+    metadata_format = MetadataFormat(args.metadata_format)
+    df = merge_shards(args.output_directory, args.shards, metadata_format)
+    ouput_file = metadata_path(args.output_directory, metadata_format)
+    if metadata_format == MetadataFormat.PARQUET:
+        shutil.rmtree(ouput_file, ignore_errors=True)
+        if not df.empty:
+            append_parquet(df.drop(columns=['StudyYear', 'StudyMonth', 'ProcessedAt'], errors='ignore'),
+                           ouput_file)
+    else:
+        df.to_csv(ouput_file, index=False)
+    logging.info(f'{len(df)} series merged from {args.shards} shards into {ouput_file}')
+
+
+if __name__ == "__main__":
+    args = manage_arguments()
+    main(args)
@@ -2,19 +2,271 @@ import dicom2nifti
 import pandas as pd
 import logging
 import os
+import time
+import tempfile
+from concurrent.futures import Executor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Union
+from src.native_nifti import native_series_to_image, NotSimpleSeries
+from src.nifti_output import save_nifti, reorient_las, DEFAULT_COMPRESSION_LEVEL
+from src.preflight import preflight_series
+from src.process_pool import ProcessPool
 
-def convert2nifti(df: pd.DataFrame) -> bool:
-    success = True
-    for s_org, s_des in zip(df['OriginalSeriesDir'], df['NiftiPath']):
-        if os.path.exists(s_des):
+# Upper bound for the DICOM bytes being converted at the same time. dicom2nifti
+# holds every slice of a series in memory, so the source size of the series is
+# a good proxy for the memory a worker needs.
+DEFAULT_MAX_INFLIGHT_BYTES = 4 * 1024 ** 3
+
+class ConversionStatus(Enum):
+    OK = "ok"
+    SKIPPED = "skipped"
+    DUPLICATE = "duplicate"
+    REJECTED = "rejected"
+    FAILED = "failed"
+
+@dataclass
+class ConversionResult:
+    series_dir: str
+    nifti_path: str
+    status: ConversionStatus
+    elapsed: float = 0.0
+    error: Union[str, None] = None
+    bytes_read: int = 0
+    bytes_written: int = 0
+    method: Union[str, None] = None
+    # CPU seconds of the conversion process, compression threads included
+    cpu: float = 0.0
+    # The failure depends only on the DICOM files, converting them again would fail too
+    permanent: bool = False
+
+def series_size(series_dir: str) -> int:
+    size = 0
+    try:
+        with os.scandir(series_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    size += entry.stat().st_size
+    except OSError as err:
+        logging.error(err)
+    return size
+
+def nifti_base(s_des: str) -> str:
+    for suffix in ('.nii.gz', '.nii'):
+        if s_des.endswith(suffix):
+            return s_des[:-len(suffix)]
+    return s_des
+
+def remove_outputs(s_des: str) -> None:
+    # NIfTI and bval/bvec of an earlier conversion of the series
+    base = nifti_base(s_des)
+    for path in (s_des, base + '.bval', base + '.bvec'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logging.error(f'CANNOT REMOVE STALE OUTPUT {path}; ERROR {err}')
+
+def remove_stale_outputs(df: pd.DataFrame, changed: set) -> int:
+    # Series whose files changed since they were converted are converted again
+    # instead of being skipped because their old NIfTI exists. Duplicates are
+    # left alone, their NiftiPath belongs to the canonical copy.
+    removed = 0
+    for row in df.to_dict('records'):
+        if row['OriginalSeriesDir'] in changed and not is_duplicate(row) and not pd.isna(row['NiftiPath']):
+            remove_outputs(row['NiftiPath'])
+            removed += 1
+    return removed
+
+def write_diffusion_files(conversion: dict, s_des: str) -> None:
+    # dicom2nifti only writes bval/bvec next to an output file of its own
+    base = nifti_base(s_des)
+    if conversion.get('BVAL') is not None:
+        dicom2nifti.common.write_bval_file(conversion['BVAL'], base + '.bval')
+    if conversion.get('BVEC') is not None:
+        dicom2nifti.common.write_bvec_file(conversion['BVEC'], base + '.bvec')
+
+def dicom2nifti_series(s_org: str) -> dict:
+    # Converted in memory and reoriented like reorient_nifti=True does. The few
+    # dicom2nifti paths that always save the image (resampling, Philips
+    # diffusion fixes) fail without an output file and get a scratch one.
+    try:
+        conversion = dicom2nifti.convert_dicom.dicom_series_to_nifti(original_dicom_directory=s_org,
+                                                                     output_file=None,
+                                                                     reorient_nifti=False)
+    except TypeError:
+        with tempfile.TemporaryDirectory() as scratch:
+            return dicom2nifti.convert_dicom.dicom_series_to_nifti(original_dicom_directory=s_org,
+                                                                   output_file=os.path.join(scratch, 'series.nii'))
+    conversion['NII'] = reorient_las(conversion['NII'])
+    return conversion
+
+def convert_series(s_org: str, s_des: str,
+                   native: bool = False,
+                   iop: Union[list, None] = None,
+                   pixel_spacing: Union[list, None] = None,
+                   compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+                   compression_threads: int = 1) -> ConversionResult:
+    # The NIfTI format (.nii or .nii.gz) follows the suffix of s_des
+    start, cpu = time.perf_counter(), time.process_time()
+    reason = preflight_series(s_org)
+    if reason is not None:
+        return ConversionResult(s_org, s_des, ConversionStatus.REJECTED, time.perf_counter() - start,
+                                reason, permanent=True, cpu=time.process_time() - cpu)
+    method = None
+    permanent = False
+    try:
+        img = None
+        if native:
+            try:
+                img = native_series_to_image(s_org, iop, pixel_spacing)
+                method = 'native'
+            except NotSimpleSeries as e:
+                logging.debug(f'NATIVE CONVERSION NOT POSSIBLE FOR {s_org}: {e}')
+        if img is None:
+            conversion = dicom2nifti_series(s_org)
+            img = conversion['NII']
+            write_diffusion_files(conversion, s_des)
+            method = 'dicom2nifti'
+        save_nifti(img, s_des, compression_level, compression_threads)
+        status, error = ConversionStatus.OK, None
+    except (OSError, MemoryError) as e:
+        # Disk, network or memory trouble, worth retrying
+        status, error = ConversionStatus.FAILED, str(e)
+    except Exception as e:
+        status, error, permanent = ConversionStatus.FAILED, str(e), True
+    result = ConversionResult(s_org, s_des, status, time.perf_counter() - start, error,
+                              method=method, cpu=time.process_time() - cpu, permanent=permanent)
+    if status == ConversionStatus.OK:
+        result.bytes_read = series_size(s_org)
+        result.bytes_written = os.path.getsize(s_des) if os.path.exists(s_des) else 0
+    return result
+
+def _float_list(value) -> Union[list, None]:
+    try:
+        return [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+
+def conversion_options(row,
+                       native: bool = False,
+                       compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+                       compression_threads: int = 1) -> dict:
+    # Keyword arguments of convert_series for a metadata row; the geometry
+    # already extracted from the headers is reused by the native converter
+    options = {'compression_level': compression_level,
+               'compression_threads': compression_threads}
+    if native:
+        options.update({'native': True,
+                        'iop': _float_list(row.get('ImageOrientationPatient')),
+                        'pixel_spacing': _float_list(row.get('PixelSpacing'))})
+    return options
+
+def is_duplicate(row) -> bool:
+    # Rows marked by src.dedup.mark_duplicates share the NIfTI of their canonical copy
+    return not pd.isna(row.get('DuplicateOf'))
+
+def no_output_path(s_org: str, s_des) -> ConversionResult:
+    # Rows without a NiftiPath cannot be converted, and would not be on a second try
+    return ConversionResult(s_org, s_des, ConversionStatus.FAILED, error='NO NIFTI PATH', permanent=True)
+
+def _finish(result: ConversionResult, on_result: Union[Callable, None]) -> None:
+    if result.status == ConversionStatus.FAILED:
+        logging.error(f'DICOM-TO-NIFIT ERROR IN SERIE {result.series_dir}; ERROR {result.error}')
+    elif result.status == ConversionStatus.REJECTED:
+        logging.warning(f'Serie {result.series_dir} not converted: {result.error}')
+    if on_result is not None:
+        on_result(result)
+
+def _conversion_result(future, s_org: str, s_des: str) -> ConversionResult:
+    try:
+        return future.result()
+    except Exception as err:
+        # The worker died (BrokenProcessPool) or its result could not be sent back
+        return ConversionResult(s_org, s_des, ConversionStatus.FAILED, error=f'{type(err).__name__}: {err}')
+
+def iter_conversions(jobs, executor: Executor, workers: int,
+                     max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES):
+    # jobs yields (key, dicom directory, nifti path, convert_series options);
+    # (key, result) pairs are yielded in completion order. When a worker dies
+    # the jobs in flight fail, and a ProcessPool is restarted for the rest.
+    pending = dict()
+    inflight = 0
+
+    def collect(return_when):
+        nonlocal inflight
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            done_key, done_size, done_org, done_des = pending.pop(future)
+            inflight -= done_size
+            yield done_key, _conversion_result(future, done_org, done_des)
+
+    for key, s_org, s_des, options in jobs:
+        size = series_size(s_org)
+        # Always let at least one series through, however big it is
+        while pending and (len(pending) >= workers or inflight + size > max_inflight_bytes):
+            yield from collect(FIRST_COMPLETED)
+        future, error = None, None
+        for _ in range(2):
+            if isinstance(executor, ProcessPool) and executor.broken:
+                # The jobs still in flight in the broken pool fail as well
+                yield from collect(ALL_COMPLETED)
+                executor.restart()
+            try:
+                future = executor.submit(convert_series, s_org, s_des, **options)
+                break
+            except BrokenProcessPool as err:
+                error = err
+        if future is None:
+            yield key, ConversionResult(s_org, s_des, ConversionStatus.FAILED,
+                                        error=f'{type(error).__name__}: {error}')
             continue
+        pending[future] = (key, size, s_org, s_des)
+        inflight += size
+    while pending:
+        yield from collect(FIRST_COMPLETED)
+
+def convert2nifti(df: pd.DataFrame,
+                  workers: int = 1,
+                  max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+                  on_result: Union[Callable, None] = None,
+                  executor: Union[Executor, None] = None,
+                  native: bool = False,
+                  compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+                  compression_threads: int = 1) -> list:
+    results = [None] * len(df)
+    jobs = list()
+    for i, row in enumerate(df.to_dict('records')):
+        s_org, s_des = row['OriginalSeriesDir'], row['NiftiPath']
+        if is_duplicate(row):
+            results[i] = ConversionResult(s_org, s_des, ConversionStatus.DUPLICATE)
+            _finish(results[i], on_result)
+        elif pd.isna(s_des):
+            results[i] = no_output_path(s_org, s_des)
+            _finish(results[i], on_result)
+        elif os.path.exists(s_des):
+            results[i] = ConversionResult(s_org, s_des, ConversionStatus.SKIPPED)
+            _finish(results[i], on_result)
         else:
-            try: 
-                dicom2nifti.convert_dicom \
-                           .dicom_series_to_nifti(original_dicom_directory=s_org,
-                                                  output_file=s_des)
-            except Exception as e:
-                logging.error(f'DICOM-TO-NIFIT ERROR IN SERIE {s_org}; ERROR {e}')
-                success = False
-                continue
-    return success
\ No newline at end of file
+            jobs.append((i, s_org, s_des, conversion_options(row, native, compression_level,
+                                                             compression_threads)))
+
+    if workers <= 1 and executor is None:
+        for i, s_org, s_des, options in jobs:
+            results[i] = convert_series(s_org, s_des, **options)
+            _finish(results[i], on_result)
+        return results
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPool(max_workers=workers)
+    try:
+        for i, result in iter_conversions(jobs, executor, workers, max_inflight_bytes):
+            results[i] = result
+            _finish(results[i], on_result)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return results
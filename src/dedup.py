@@ -0,0 +1,94 @@
+import os
+import hashlib
+import logging
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+def content_fingerprint(series_dir: str) -> str:
+    # File count, total size, the sorted file sizes and the content of the
+    # middle file. Cheap next to a conversion and independent of the folder the
+    # series was exported to.
+    try:
+        with os.scandir(series_dir) as it:
+            files = sorted((e.name, e.stat().st_size) for e in it if e.is_file())
+        digest = hashlib.sha1(repr(sorted(size for _, size in files)).encode())
+        if files:
+            with open(os.path.join(series_dir, files[len(files) // 2][0]), 'rb') as f:
+                digest.update(f.read())
+    except OSError as err:
+        logging.error(f'ERROR FINGERPRINTING SERIE {series_dir}; ERROR {err}')
+        return ''
+    return f'{len(files)}:{sum(size for _, size in files)}:{digest.hexdigest()[:16]}'
+
+class DuplicateIndex:
+    # Canonical copy of every (SeriesInstanceUID, content fingerprint) seen by
+    # a run, or by earlier runs when seeded from the manifest. Contents are only
+    # fingerprinted once a SeriesInstanceUID shows up in more than one
+    # directory, so archives without duplicates pay nothing.
+    def __init__(self):
+        self._first = dict()        # SeriesInstanceUID -> first directory seen
+        self._seeded = dict()       # SeriesInstanceUID -> directories of earlier runs, oldest first
+        self._canonical = dict()    # (SeriesInstanceUID, fingerprint) -> canonical directory
+        self._fingerprints = dict() # directory -> content fingerprint
+        self._lock = threading.Lock()
+
+    def seed(self, series_uids: list) -> None:
+        # (directory, SeriesInstanceUID) pairs processed before, oldest first
+        with self._lock:
+            for s, u in series_uids:
+                self._seeded.setdefault(u, []).append(s)
+
+    def _fingerprint_all(self, series: list, workers: int) -> None:
+        series = [s for s in dict.fromkeys(series) if s not in self._fingerprints]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                self._fingerprints.update(zip(series, executor.map(content_fingerprint, series)))
+        else:
+            self._fingerprints.update((s, content_fingerprint(s)) for s in series)
+
+    def resolve(self, series: list, uids: list, workers: int = 1) -> tuple:
+        # Returns the content fingerprint (None when not needed) and the
+        # canonical directory (None for the canonical copy itself) of each series
+        with self._lock:
+            counts = pd.Series(uids).value_counts(dropna=True).to_dict()
+            for u in counts:
+                # The oldest copy of an earlier run that is still on disk
+                for s in self._seeded.pop(u, []):
+                    if os.path.isdir(s):
+                        self._first[u] = s
+                        break
+            shared = {u for u in counts if counts[u] > 1 or u in self._first}
+            # Series seen again (e.g. modified since) are fingerprinted again
+            for s in series:
+                self._fingerprints.pop(s, None)
+            self._fingerprint_all([s for s, u in zip(series, uids) if u in shared]
+                                  + [self._first[u] for u in shared if u in self._first], workers)
+            for u in shared:
+                if u in self._first:
+                    first = self._first[u]
+                    self._canonical.setdefault((u, self._fingerprints[first]), first)
+
+            fingerprints, duplicate_of = list(), list()
+            for s, u in zip(series, uids):
+                if u not in shared:
+                    if not pd.isna(u):
+                        self._first[u] = s
+                    fingerprints.append(None)
+                    duplicate_of.append(None)
+                    continue
+                self._first.setdefault(u, s)
+                fingerprint = self._fingerprints[s]
+                # An unreadable series is never taken for a copy of another one
+                canonical = self._canonical.setdefault((u, fingerprint), s) if fingerprint else s
+                fingerprints.append(fingerprint)
+                duplicate_of.append(canonical if canonical != s else None)
+            return fingerprints, duplicate_of
+
+def mark_duplicates(df: pd.DataFrame, index: DuplicateIndex, workers: int = 1) -> None:
+    # Adds ContentFingerprint and DuplicateOf (directory of the copy that is
+    # converted, empty for that copy) to the metadata
+    fingerprints, duplicate_of = index.resolve(list(df['OriginalSeriesDir']),
+                                               list(df['SeriesInstanceUID']), workers)
+    df['ContentFingerprint'] = pd.Series(fingerprints, index=df.index, dtype=object)
+    df['DuplicateOf'] = pd.Series(duplicate_of, index=df.index, dtype=object)
@@ -1,18 +1,41 @@
 import logging
 from striprtf.striprtf import rtf_to_text
 import io
+import re
 from db.db_access import DatabaseAccess
 import pandas as pd
 import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from functools import partial
+from typing import Iterator, Union
 
-def anonymize_rtf(rtf_in: str) -> str:
+class FormStatus(Enum):
+    OK = "ok"
+    SKIPPED = "skipped"
+    MISSING = "missing"
+    FAILED = "failed"
+
+FORMS_QUERY_CHUNK = 1000
+
+# Report lines matching any of these regular expressions are removed
+DEFAULT_ANONYMIZATION_PATTERNS = [re.escape('Paciente'), re.escape('Solicitado por:')]
+
+def compile_anonymization_patterns(patterns: Union[list, None] = None) -> re.Pattern:
+    patterns = DEFAULT_ANONYMIZATION_PATTERNS if patterns is None else patterns
+    return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+DEFAULT_ANONYMIZATION_PATTERN = compile_anonymization_patterns()
+
+def anonymize_rtf(rtf_in: str, pattern: re.Pattern = DEFAULT_ANONYMIZATION_PATTERN) -> str:
     out_form: str = ""
     try:
         text = rtf_to_text(str(rtf_in))
         text_in = io.StringIO(text)
         text_out = io.StringIO()
         for line in text_in:
-            if ('Paciente' in line) or ('Solicitado por:' in line):
+            if pattern.search(line):
                 continue
             else:
                 text_out.write(line)
@@ -22,50 +45,124 @@ def anonymize_rtf(rtf_in: str) -> str:
         logging.error('FAIL TO CONVERT RTF IN TO TEXT')
     return out_form
 
-def get_forms(date_id: list, db_access: DatabaseAccess) -> pd.DataFrame:
-    df_result = pd.DataFrame(columns = ['DateID', 'Form'])
-    L = len(date_id)
-    N = 1000 if 1000 < L else L
-    for s in range(0, L, N):
-        d = tuple(date_id[s: s + N])
-        if len(date_id) > 1:
-            sql_query = f"SELECT IDCita AS DateID, \
-                                 InformeRTF AS Form \
-                          FROM CITAS_INFORMES \
-                          WHERE IDCita IN {d} AND Numero = 1"
-        else:
-            sql_query = f"SELECT IDCita AS DateID, \
-                                 InformeRTF AS Form \
-                          FROM CITAS_INFORMES \
-                          WHERE IDCita = {d} AND Numero = 1"
-        df_tmp = db_access.run_query(sql_query)
-        if df_tmp.empty:
+def iter_raw_forms(date_id: list, db_access: DatabaseAccess) -> Iterator[pd.DataFrame]:
+    for s in range(0, len(date_id), FORMS_QUERY_CHUNK):
+        d = tuple(int(i) for i in date_id[s: s + FORMS_QUERY_CHUNK])
+        sql_query = f"SELECT IDCita AS DateID, \
+                             InformeRTF AS Form \
+                      FROM CITAS_INFORMES \
+                      WHERE IDCita IN ({','.join(['%s'] * len(d))}) AND Numero = 1"
+        empty = True
+        for df_tmp in db_access.iter_query(sql_query, d):
+            empty = empty and df_tmp.empty
+            yield df_tmp
+        if empty:
             logging.error('NO FORMS RETURNED FROM QUERY')
-        else:
-            df_result = pd.concat([df_result, df_tmp], ignore_index=True)
-
-    df_result.drop_duplicates(inplace=True)
-    df_result['Form']  = df_result['Form'].apply(lambda x: anonymize_rtf(x))
-    return df_result
 
-def extract_forms(df: pd.DataFrame, db_access: DatabaseAccess) -> bool:
-    result = True
-    df_forms = get_forms(list(set(df['DateID'])), db_access)
-    for d in set(df_forms['DateID']):
-        path = df[df['DateID'] == d].iloc[0]['FormPath']
-        form = df_forms[df_forms['DateID'] == d].iloc[0]['Form']
-        if os.path.exists(path):
+def iter_forms(date_id: list,
+               db_access: DatabaseAccess,
+               pattern: re.Pattern = DEFAULT_ANONYMIZATION_PATTERN,
+               executor: Union[Executor, None] = None) -> Iterator[tuple]:
+    # Yields (DateID, anonymized form). With an executor the chunk fetched from
+    # the DB is converted in the pool while the next chunk is being fetched, so
+    # at most two chunks of raw RTF are held in memory.
+    anonymize = partial(anonymize_rtf, pattern=pattern)
+    seen = set()
+    previous = None
+    for df_tmp in iter_raw_forms(date_id, db_access):
+        df_tmp = df_tmp[~df_tmp['DateID'].isin(seen)].drop_duplicates(subset='DateID')
+        seen.update(df_tmp['DateID'])
+        ids = [int(d) for d in df_tmp['DateID']]
+        if executor is None:
+            yield from zip(ids, map(anonymize, df_tmp['Form']))
             continue
-        else:
-            try:
-                with open(path, 'w',  encoding="utf-8", errors='ignore') as f:
-                    f.write(form)
-            except Exception as e:
-                logging.error(f'ERROR WHILE EXTRACTING FORMS FOR DATEID: {d}')
-                result = result and False
-                continue
-    return result
+        futures = [executor.submit(anonymize, f) for f in df_tmp['Form']]
+        if previous is not None:
+            yield from ((d, f.result()) for d, f in zip(*previous))
+        previous = (ids, futures)
+    if previous is not None:
+        yield from ((d, f.result()) for d, f in zip(*previous))
+
+def get_forms(date_id: list,
+              db_access: DatabaseAccess,
+              pattern: re.Pattern = DEFAULT_ANONYMIZATION_PATTERN) -> pd.DataFrame:
+    return pd.DataFrame(list(iter_forms(date_id, db_access, pattern)), columns=['DateID', 'Form'])
+
+def write_form(date_id: int, path: str, form: str, overwrite: bool = False) -> FormStatus:
+    if os.path.exists(path) and not overwrite:
+        return FormStatus.SKIPPED
+    try:
+        # Replaced in one step, a report written again is never left truncated
+        tmp = path + '.part'
+        with open(tmp, 'w',  encoding="utf-8", errors='ignore') as f:
+            f.write(form)
+        os.replace(tmp, path)
+    except Exception as e:
+        logging.error(f'ERROR WHILE EXTRACTING FORMS FOR DATEID: {date_id}; ERROR {e}')
+        return FormStatus.FAILED
+    return FormStatus.OK
 
+def form_paths(df: pd.DataFrame) -> dict:
+    # DateID -> FormPath of its first series, built once instead of masking df per DateID
+    paths = df.dropna(subset=['DateID']) \
+              .drop_duplicates(subset='DateID') \
+              .set_index('DateID')['FormPath'] \
+              .to_dict()
+    return {int(d): p for d, p in paths.items()}
 
+def export_forms(paths: dict,
+                 db_access: DatabaseAccess,
+                 workers: int = 1,
+                 pattern: re.Pattern = DEFAULT_ANONYMIZATION_PATTERN,
+                 anonymize_workers: int = 1,
+                 anonymizer: Union[Executor, None] = None,
+                 refresh: Union[set, None] = None) -> dict:
+    # paths maps DateID -> FormPath. Reports already on disk are not fetched
+    # again, unless their DateID is in refresh.
+    refresh = {int(d) for d in refresh or set() if not pd.isna(d)}
+    result = dict()
+    for d, p in paths.items():
+        if pd.isna(p):
+            logging.error(f'NO FORM PATH FOR DATEID: {d}')
+            result[d] = FormStatus.FAILED
+        elif d not in refresh and os.path.exists(p):
+            result[d] = FormStatus.SKIPPED
+    pending = [d for d in paths if d not in result]
 
+    own_anonymizer = anonymizer is None and anonymize_workers > 1
+    if own_anonymizer:
+        anonymizer = ProcessPoolExecutor(max_workers=anonymize_workers)
+    writer = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        writes = dict()
+        try:
+            for d, form in iter_forms(pending, db_access, pattern, anonymizer):
+                if writer is None:
+                    result[d] = write_form(d, paths[d], form, d in refresh)
+                else:
+                    writes[d] = writer.submit(write_form, d, paths[d], form, d in refresh)
+        except BrokenProcessPool as err:
+            # An anonymizer worker died, the reports not written yet fail and are retried
+            logging.error(f'ERROR WHILE ANONYMIZING FORMS; ERROR {err}')
+            result.update((d, FormStatus.FAILED) for d in pending if d not in result and d not in writes)
+        result.update((d, f.result()) for d, f in writes.items())
+    finally:
+        if own_anonymizer:
+            anonymizer.shutdown()
+        if writer is not None:
+            writer.shutdown()
+
+    for d in pending:
+        if d not in result:
+            result[d] = FormStatus.MISSING
+    return result
 
+def extract_forms(df: pd.DataFrame,
+                  db_access: DatabaseAccess,
+                  workers: int = 1,
+                  pattern: re.Pattern = DEFAULT_ANONYMIZATION_PATTERN,
+                  anonymize_workers: int = 1,
+                  anonymizer: Union[Executor, None] = None,
+                  refresh: Union[set, None] = None) -> dict:
+    return export_forms(form_paths(df), db_access, workers, pattern, anonymize_workers,
+                        anonymizer, refresh)
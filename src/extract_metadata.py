@@ -1,5 +1,5 @@
 import os
-import glob
+import time
 import numpy as np
 import pandas as pd
 import pydicom
@@ -8,117 +8,228 @@ import re
 from enum import Enum
 from typing import Union
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from db.db_access import DatabaseAccess
+from db.id_date_cache import IdDateCache
+from src.pseudonyms import PseudonymIndex
+from src.instrumentation import RunMetrics
 import logging
 
 class RegexAccNum(Enum):
     NORMAL = "(\d{1})\.(\d+)\.(\d{1})\.(\d{1})"
 
-def get_id_date_ext(acc_num:str, db_access: DatabaseAccess) -> Union[int, None]:
-    id_date = None
-    query = f"SELECT TOP 1 IDCita FROM CITAS_EXPLORACIONES WHERE AANN_Externo = '{acc_num}'"
-    df_result = db_access.run_query(query)
+ID_DATE_QUERY_CHUNK = 1000
+
+def parse_id_date(acc_num: str) -> Union[int, None]:
+    match = re.match(RegexAccNum.NORMAL.value, acc_num)
+    return int(match.group(2)) if match else None
+
+def get_id_dates_ext(acc_nums: list, db_access: DatabaseAccess) -> dict:
+    id_dates = dict()
+    for s in range(0, len(acc_nums), ID_DATE_QUERY_CHUNK):
+        chunk = acc_nums[s: s + ID_DATE_QUERY_CHUNK]
+        placeholders = ','.join(['%s'] * len(chunk))
+        query = f"SELECT AANN_Externo, IDCita FROM CITAS_EXPLORACIONES WHERE AANN_Externo IN ({placeholders})"
+        df_result = db_access.run_query(query, tuple(chunk))
+        if df_result.empty:
+            continue
+        df_result = df_result.drop_duplicates(subset='AANN_Externo')
+        for acc_num, id_date in zip(df_result['AANN_Externo'], df_result['IDCita']):
+            try:
+                id_dates[acc_num] = int(id_date)
+            except (TypeError, ValueError) as err:
+                logging.error(f'INVALID IDCITA {id_date} FOR ACCESSION NUMBER {acc_num}; ERROR {err}')
+    return id_dates
+
+def resolve_id_dates(acc_nums: list,
+                     db_access: DatabaseAccess,
+                     cache: Union[IdDateCache, None] = None) -> dict:
+    id_dates = dict()
+    pending = list()
+    for acc_num in set(a for a in acc_nums if isinstance(a, str)):
+        id_date = parse_id_date(acc_num)
+        if id_date is None:
+            pending.append(acc_num)
+        else:
+            id_dates[acc_num] = id_date
+
+    if cache is not None and pending:
+        cached = cache.get_many(pending)
+        id_dates.update(cached)
+        pending = [a for a in pending if a not in cached]
+
+    if pending:
+        found = get_id_dates_ext(pending, db_access)
+        for acc_num in pending:
+            if acc_num not in found:
+                logging.error(f'NO IDCITA FOUND FOR ACCESSION NUMBER {acc_num}')
+        id_dates.update({a: found.get(a) for a in pending})
+        # Misses are not cached: an empty answer may come from a failed connection
+        if cache is not None:
+            cache.put_many(found)
+    return id_dates
+
+def image_planes(iop: pd.Series) -> pd.Series:
+    # Plane of the rounded slice normal, with one cross product over the whole N x 6 column
+    valid = iop.map(lambda x: x is not None and not isinstance(x, float) and len(x) == 6).to_numpy(dtype=bool)
+    planes = np.full(len(iop), None, dtype=object)
+    if valid.any():
+        iop_round = np.rint(np.array(iop[valid].tolist(), dtype=float))
+        normal = np.abs(np.cross(iop_round[:, 0:3], iop_round[:, 3:6]))
+        planes[valid] = np.select([normal[:, 0] == 1, normal[:, 1] == 1, normal[:, 2] == 1],
+                                  ['Sagittal', 'Coronal', 'Axial'], default=None)
+    return pd.Series(planes, index=iop.index, dtype=object)
+
+def first_dicom_file(series_dir: str) -> Union[str, None]:
     try:
-        id_date = int(df_result['IDCita'])
-    except Exception as err:
+        with os.scandir(series_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.dcm') and entry.is_file():
+                    return entry.path
+    except OSError as err:
         logging.error(err)
-    return id_date
+    return None
+
+def study_date(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, '%Y%m%d')
+
+def float_list(value) -> list:
+    return [float(v) for v in value]
+
+# Metadata column -> (DICOM tag, transformation applied to the tag value). Values
+# are turned into plain Python types so no pydicom objects are kept in the frame.
+DICOM_TAGS = OrderedDict({
+                          'OriginalPatientId': (0x00100020, str),
+                          'StudyId': (0x00200010, str),
+                          'StudyInstanceUID': (0x0020000D, str),
+                          'SeriesInstanceUID': (0x0020000E, str),
+                          'AccessionNumber': (0x00080050, str),
+                          'SeriesDescription': (0x0008103E, str),
+                          'RepetitionTime': (0x00180080, float),
+                          'EchoTime': (0x00180081, float),
+                          'InversionTime': (0x00180082, float),
+                          'ImageOrientationPatient': (0x00200037, float_list),
+                          'StudyDate': (0x00080020, study_date),
+                          'MRAdquisitionType': (0x00180023, str),
+                          'PatientSex': (0x00100040, str),
+                          'PatientBirthday': (0x00100030, str),
+                          'Manufacturer': (0x00080070, str),
+                          'ManufacturersModelName': (0x00081090, str),
+                          'MagneticFieldStrength': (0x00180087, float),
+                          'SpacingBetweenSlices': (0x00180088, float),
+                          'SliceThickness': (0x00180050, float),
+                          'PixelSpacing': (0x00280030, float_list),
+                          'SamplesPerPixel': (0x00280002, int),
+                          'Rows': (0x00280010, int),
+                          'Columns': (0x00280011, int),
+                          'BitsAllocated': (0x00280100, int),
+                          'BitsStored': (0x00280101, int),
+                          'HighBit': (0x00280102, int),
+                          'PixelRepresentation': (0x00280103, int),
+                          })
+# ImagePlane is derived from ImageOrientationPatient once the rows are in a frame
+METADATA_COLUMNS = ['OriginalSeriesDir'] + list(DICOM_TAGS)
+METADATA_COLUMNS.insert(METADATA_COLUMNS.index('ImageOrientationPatient'), 'ImagePlane')
+HEADER_TAGS = sorted(set(tag for tag, _ in DICOM_TAGS.values()))
 
-def get_id_date(acc_num:str, db_access:DatabaseAccess) -> Union[int, None]:
-    id_date = None
+# In-memory dtypes of the metadata frame, the other columns hold str or lists of float
+METADATA_DTYPES = {'RepetitionTime': 'float64',
+                   'EchoTime': 'float64',
+                   'InversionTime': 'float64',
+                   'MagneticFieldStrength': 'float64',
+                   'SpacingBetweenSlices': 'float64',
+                   'SliceThickness': 'float64',
+                   'SamplesPerPixel': 'UInt8',
+                   'Rows': 'UInt16',
+                   'Columns': 'UInt16',
+                   'BitsAllocated': 'UInt8',
+                   'BitsStored': 'UInt8',
+                   'HighBit': 'UInt8',
+                   'PixelRepresentation': 'UInt8',
+                   'ImagePlane': 'category',
+                   'MRAdquisitionType': 'category',
+                   'PatientSex': 'category',
+                   'Manufacturer': 'category',
+                   'ManufacturersModelName': 'category',
+                   'StudyDate': 'datetime64[ns]'}
+
+def read_series_header(series_dir: str, metrics: Union[RunMetrics, None] = None) -> Union[pydicom.Dataset, None]:
+    img = first_dicom_file(series_dir)  #Take only the first image in the serie
+    if img is None:
+        return None
     try:
-        if re.match(RegexAccNum.NORMAL.value, acc_num):
-            id_date = int(re.match(RegexAccNum.NORMAL.value, acc_num).group(2))
-        else:
-            id_date = get_id_date_ext(acc_num, db_access)
+        # Only the table's tags are parsed, large private vendor blocks are skipped
+        with open(img, 'rb') as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+            if metrics is not None:
+                metrics.count('header_bytes_read', f.tell())
+        return ds
     except Exception as err:
-        logging.error(err)
-    return id_date
-
-def image_plane(IOP) -> str:
-    IOP_round = [round(x) for x in IOP]
-    plane = np.cross(IOP_round[0:3], IOP_round[3:6])
-    plane = [abs(x) for x in plane]
-    if plane[0] == 1:
-        return "Sagittal"
-    elif plane[1] == 1:
-        return "Coronal"
-    elif plane[2] == 1:
-        return "Axial"
-
-def extract_dicom_metadata(series: list) -> pd.DataFrame:
-    metadata = OrderedDict({
-                            'OriginalSeriesDir': list(),
-                            'OriginalPatientId': list(),
-                            'StudyId':list(),
-                            'StudyInstanceUID':list(),
-                            'SeriesInstanceUID': list(),
-                            'AccessionNumber': list(),
-                            'SeriesDescription': list(),
-                            'RepetitionTime': list(),
-                            'EchoTime':list(),
-                            'InversionTime': list(),
-                            'ImagePlane': list(),
-                            'StudyDate': list(),
-                            'MRAdquisitionType': list(),
-                            'PatientSex': list(),
-                            'PatientBirthday': list(),
-                            'Manufacturer': list(),
-                            'ManufacturersModelName': list(),
-                            'MagneticFieldStrength': list(),
-                            'SpacingBetweenSlices': list(),
-                            'SliceThickness': list(),
-                            'PixelSpacing': list(),
-                            'SamplesPerPixel': list(),
-                            'Rows': list(),
-                            'Columns': list(),
-                            'BitsAllocated': list(),
-                            'BitsStored': list(),
-                            'HighBit': list(),
-                            'PixelRepresentation': list(),
-                            })
-    for s in series:
-        if len(glob.glob(os.path.join(s, '*.dcm'))) > 0:
-            img = glob.glob(os.path.join(s, '*.dcm'))[0]  #Take only the first image in the serie
-            ds = pydicom.dcmread(img, stop_before_pixels=True)
-            metadata['OriginalSeriesDir'].append(s)
-            metadata['OriginalPatientId'].append(ds[0x0010, 0x0020].value if (0x0020, 0x0010) in ds else None)
-            metadata['StudyId'].append(ds[0x0020, 0x0010].value if (0x0020, 0x0010) in ds else None)
-            metadata['StudyInstanceUID'].append(ds[0x0020, 0x000D].value if (0x0020, 0x000D) in ds else None)
-            metadata['SeriesInstanceUID'].append(ds[0x0020, 0x00E].value if (0x0020, 0x00E) in ds else None)
-            metadata['AccessionNumber'].append(ds[0x0008, 0x0050].value if (0x0008, 0x0050) in ds else None)
-            metadata['SeriesDescription'].append(ds[0x0008, 0x103E].value if (0x0008, 0x103E) in ds else None)
-            metadata['InversionTime'].append(ds[0x0018,0x0082].value if (0x0018,0x0082) in ds else None)
-            metadata['RepetitionTime'].append(ds[0x0018,0x0080].value if (0x0018,0x0080) in ds else None)
-            metadata['EchoTime'].append(ds[0x0018,0x0081].value if (0x0018,0x0081) in ds else None)
-            metadata['ImagePlane'].append(image_plane(ds[0x0020,0x0037].value) if (0x0020,0x0037) in ds else None)
-            metadata['StudyDate'].append(datetime.datetime.strptime(ds[0x0008,0x0020].value, '%Y%m%d') 
-                                         if (0x0008,0x0020) in ds else None)
-            metadata['MRAdquisitionType'].append(ds[0x0018,0x0023].value if (0x0018,0x0023) in ds else None)
-            metadata['PatientSex'].append(ds[0x0010,0x0040].value if (0x0010,0x0040) in ds else None)
-            metadata['PatientBirthday'].append(ds[0x0010,0x0030].value if (0x0010,0x0030) in ds else None)
-            metadata['Manufacturer'].append(ds[0x0008,0x0070].value if (0x0008,0x0070) in ds else None)
-            metadata['ManufacturersModelName'].append(ds[0x0008,0x1090].value if (0x0008,0x1090) in ds else None)
-            metadata['MagneticFieldStrength'].append(ds[0x0018,0x0087].value if (0x0018,0x0087) in ds else None)
-            metadata['SpacingBetweenSlices'].append(ds[0x0018,0x0088].value if (0x0018,0x0088) in ds else None)
-            metadata['SliceThickness'].append(ds[0x0018,0x0050].value if (0x0018,0x0050) in ds else None)
-            metadata['PixelSpacing'].append(ds[0x0028,0x0030].value if (0x0028,0x0030) in ds else None)
-            metadata['SamplesPerPixel'].append(ds[0x0028,0x0002].value if (0x0028,0x0002) in ds else None)
-            metadata['Rows'].append(ds[0x0028,0x0010].value if (0x0028,0x0010) in ds else None)
-            metadata['Columns'].append(ds[0x0028,0x0011].value if (0x0028,0x0011) in ds else None)
-            metadata['BitsAllocated'].append(ds[0x0028,0x0100].value if (0x0028,0x0100) in ds else None)
-            metadata['BitsStored'].append(ds[0x0028,0x0101].value if (0x0028,0x0101) in ds else None)
-            metadata['HighBit'].append(ds[0x0028,0x0102].value if (0x0028,0x0102) in ds else None)
-            metadata['PixelRepresentation'].append(ds[0x0028,0x0103].value if (0x0028,0x0103) in ds else None)
-    return pd.DataFrame(metadata)
-
-def extract_metadata(series: list, db_access:DatabaseAccess) -> pd.DataFrame:
-    transformedPatientIDs = OrderedDict()
-    df_meta = extract_dicom_metadata(series)
-    
-    for i, p in enumerate(set(df_meta['OriginalPatientId'])):
-        transformedPatientIDs[p] = 'Sub-' + str(i)
-    
-    df_meta['PatientID'] = df_meta['OriginalPatientId'].apply(lambda x: transformedPatientIDs[x])
-    df_meta['DateID'] = df_meta['AccessionNumber'].apply(lambda x: get_id_date(x, db_access))
+        logging.error(f'ERROR READING DICOM HEADER {img}; ERROR {err}')
+        return None
+
+def header_to_metadata(series_dir: str, ds: pydicom.Dataset) -> dict:
+    row = {'OriginalSeriesDir': series_dir}
+    for column, (tag, transform) in DICOM_TAGS.items():
+        value = ds[tag].value if tag in ds else None
+        if value in (None, ''):
+            value = None
+        elif transform is not None:
+            try:
+                value = transform(value)
+            except (TypeError, ValueError) as err:
+                logging.error(f'INVALID VALUE FOR {column} IN SERIE {series_dir}; ERROR {err}')
+                value = None
+        row[column] = value
+    return row
+
+def extract_series_metadata(series_dir: str, metrics: Union[RunMetrics, None] = None) -> Union[dict, None]:
+    # Scans run in threads, so CPU time is that of the calling thread
+    wall, cpu = time.perf_counter(), time.thread_time()
+    ds = read_series_header(series_dir, metrics)
+    row = header_to_metadata(series_dir, ds) if ds is not None else None
+    if metrics is not None:
+        metrics.observe_series('extract_metadata', series_dir, time.perf_counter() - wall,
+                               time.thread_time() - cpu)
+    return row
+
+def coerce_metadata(df: pd.DataFrame) -> pd.DataFrame:
+    return df.astype({c: t for c, t in METADATA_DTYPES.items() if c in df})
+
+def metadata_frame(rows: list) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=METADATA_COLUMNS)
+    df['ImagePlane'] = image_planes(df['ImageOrientationPatient'])
+    return coerce_metadata(df)
+
+def extract_dicom_metadata(series: list, workers: int = 1,
+                           metrics: Union[RunMetrics, None] = None) -> pd.DataFrame:
+    scan = partial(extract_series_metadata, metrics=metrics)
+    if workers <= 1:
+        rows = [scan(s) for s in series]
+    else:
+        # Header reads are dominated by I/O latency, threads are enough to overlap them
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(scan, series))
+    return metadata_frame([r for r in rows if r is not None])
+
+def assign_patient_ids(df_meta: pd.DataFrame, pseudonyms: PseudonymIndex) -> None:
+    patient_ids = pseudonyms.assign(list(df_meta['OriginalPatientId']))
+    df_meta['PatientID'] = df_meta['OriginalPatientId'].map(patient_ids)
+
+def assign_date_ids(df_meta: pd.DataFrame,
+                    db_access: DatabaseAccess,
+                    id_date_cache: Union[IdDateCache, None] = None) -> None:
+    id_dates = resolve_id_dates(list(df_meta['AccessionNumber']), db_access, id_date_cache)
+    df_meta['DateID'] = df_meta['AccessionNumber'].map(id_dates).astype('Int64')
+
+def extract_metadata(series: list,
+                     db_access:DatabaseAccess,
+                     id_date_cache: Union[IdDateCache, None] = None,
+                     workers: int = 1,
+                     pseudonyms: Union[PseudonymIndex, None] = None,
+                     metrics: Union[RunMetrics, None] = None) -> pd.DataFrame:
+    df_meta = extract_dicom_metadata(series, workers, metrics)
+    assign_patient_ids(df_meta, pseudonyms if pseudonyms is not None else PseudonymIndex())
+    assign_date_ids(df_meta, db_access, id_date_cache)
     return df_meta
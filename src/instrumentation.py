@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import bisect
+import cProfile
+import datetime
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Union
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SLOWEST_SERIES = 20
+PROMETHEUS_PREFIX = 'preprocessing'
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        total, out = 0, list()
+        for le, c in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += c
+            out.append((le, total))
+        return out
+
+    def to_dict(self) -> dict:
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': {str(le): c for le, c in self.cumulative()}}
+
+class RunMetrics:
+    def __init__(self, profile_stages: Union[list, None] = None, profile_dir: Union[str, None] = None):
+        self.started = datetime.datetime.now()
+        self.counters = Counter()
+        self.stages = dict()
+        self.histograms = dict()
+        self.slowest = list()
+        self.profile_stages = set(profile_stages or [])
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def observe_series(self, stage: str, series_dir: str, seconds: float,
+                       cpu_seconds: Union[float, None] = None) -> None:
+        self.observe(f'{stage}_series_seconds', seconds)
+        if cpu_seconds is not None:
+            self.observe(f'{stage}_series_cpu_seconds', cpu_seconds)
+        with self._lock:
+            self.slowest.append((seconds, stage, series_dir))
+            self.slowest = sorted(self.slowest, reverse=True)[:SLOWEST_SERIES]
+
+    def record_conversion(self, result) -> None:
+        self.count(f'series_{result.status.value}')
+        if result.status.value == 'ok':
+            # Size of the DICOM series converted and of the NIfTI written for them
+            self.count('dicom_bytes_converted', result.bytes_read)
+            self.count('nifti_bytes_written', result.bytes_written)
+            self.count(f'converted_{result.method}')
+        if result.status.value in ('ok', 'rejected', 'failed'):
+            self.observe_series('convert2nifti', result.series_dir, result.elapsed, result.cpu)
+
+    def record_forms(self, statuses: dict) -> None:
+        for status in statuses.values():
+            self.count(f'forms_{status.value}')
+
+    @contextmanager
+    def stage(self, name: str):
+        # cProfile only sees the calling thread, worker threads and processes are not profiled
+        profiler = cProfile.Profile() if name in self.profile_stages else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir or '.', f'{name}.prof'))
+            with self._lock:
+                s = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'calls': 0})
+                s['wall_s'] += time.perf_counter() - wall
+                s['cpu_s'] += time.process_time() - cpu
+                s['calls'] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {'started': self.started.isoformat(),
+                    'finished': datetime.datetime.now().isoformat(),
+                    'stages': dict(self.stages),
+                    'counters': dict(self.counters),
+                    'histograms': {k: h.to_dict() for k, h in self.histograms.items()},
+                    'slowest_series': [{'stage': st, 'series': s, 'seconds': t}
+                                       for t, st, s in self.slowest]}
+
+    def write_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path: str) -> None:
+        p = PROMETHEUS_PREFIX
+        lines = list()
+        with self._lock:
+            for metric, key in (('stage_wall_seconds', 'wall_s'), ('stage_cpu_seconds', 'cpu_s')):
+                lines.append(f'# TYPE {p}_{metric} gauge')
+                for name, s in self.stages.items():
+                    lines.append(f'{p}_{metric}{{stage="{name}"}} {s[key]}')
+            for name, value in self.counters.items():
+                lines.append(f'# TYPE {p}_{name}_total counter')
+                lines.append(f'{p}_{name}_total {value}')
+            for name, h in self.histograms.items():
+                lines.append(f'# TYPE {p}_{name} histogram')
+                for le, c in h.cumulative():
+                    lines.append(f'{p}_{name}_bucket{{le="{le}"}} {c}')
+                lines.append(f'{p}_{name}_sum {h.sum}')
+                lines.append(f'{p}_{name}_count {h.count}')
+        lines.append(f'{p}_last_run_timestamp_seconds {time.time()}')
+        # The textfile collector may read at any time, replace the file atomically
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
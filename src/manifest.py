@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+from enum import Enum
+from typing import Union
+from src.convert_to_nifti import ConversionResult, ConversionStatus
+from src.extract_forms import FormStatus
+
+class SeriesState(Enum):
+    SCANNED = "scanned"
+    DONE = "done"
+    FAILED = "failed"
+
+def series_fingerprint(series_dir: str) -> str:
+    count, size, mtime = 0, 0, 0
+    try:
+        with os.scandir(series_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    count += 1
+                    size += st.st_size
+                    mtime = max(mtime, st.st_mtime_ns)
+    except OSError as err:
+        logging.error(err)
+    return f'{count}:{size}:{mtime}'
+
+class ProcessingManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS series ("
+                               "series_dir TEXT PRIMARY KEY, "
+                               "series_uid TEXT, "
+                               "fingerprint TEXT, "
+                               "state TEXT, "
+                               "updated REAL)")
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(series)")]
+            if 'error' not in columns:
+                self._conn.execute("ALTER TABLE series ADD COLUMN error TEXT")
+            # Reports are per DateID and kept apart, a series is done even if its report is missing
+            self._conn.execute("CREATE TABLE IF NOT EXISTS forms ("
+                               "date_id INTEGER PRIMARY KEY, "
+                               "form_path TEXT, "
+                               "state TEXT, "
+                               "updated REAL)")
+
+    def _with_state(self, fingerprints: dict, states: tuple) -> list:
+        with self._lock:
+            known = dict(self._conn.execute("SELECT series_dir, fingerprint FROM series "
+                                            f"WHERE state IN ({','.join('?' * len(states))})",
+                                            [s.value for s in states]))
+        return [s for s, f in fingerprints.items() if known.get(s) == f]
+
+    def pending(self, fingerprints: dict, retry_failed: bool = False) -> list:
+        # Series that failed are skipped until their files change, unless retry_failed
+        states = (SeriesState.DONE,) if retry_failed else (SeriesState.DONE, SeriesState.FAILED)
+        finished = set(self._with_state(fingerprints, states))
+        return [s for s in fingerprints if s not in finished]
+
+    def failed(self, fingerprints: dict) -> list:
+        return self._with_state(fingerprints, (SeriesState.FAILED,))
+
+    def changed(self, fingerprints: dict) -> list:
+        # Series processed before whose files changed since, their outputs are stale
+        with self._lock:
+            known = dict(self._conn.execute("SELECT series_dir, fingerprint FROM series"))
+        return [s for s, f in fingerprints.items() if s in known and known[s] != f]
+
+    def series_uids(self) -> list:
+        # (directory, SeriesInstanceUID) of the series not failed, in the order
+        # they were first scanned; the first directory of a UID is its canonical copy
+        with self._lock:
+            return self._conn.execute("SELECT series_dir, series_uid FROM series "
+                                      "WHERE series_uid IS NOT NULL AND state != ? ORDER BY rowid",
+                                      (SeriesState.FAILED.value,)).fetchall()
+
+    def mark(self, series_dir: str, fingerprint: str, state: SeriesState,
+             series_uid: Union[str, None] = None, error: Union[str, None] = None) -> None:
+        self.mark_many([(series_dir, fingerprint, series_uid)], state, error)
+
+    def mark_many(self, series: list, state: SeriesState, error: Union[str, None] = None) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO series (series_dir, series_uid, fingerprint, state, updated, error) "
+                                   "VALUES (?, ?, ?, ?, ?, ?) "
+                                   "ON CONFLICT(series_dir) DO UPDATE SET "
+                                   "series_uid = COALESCE(excluded.series_uid, series_uid), "
+                                   "fingerprint = excluded.fingerprint, "
+                                   "state = excluded.state, "
+                                   "updated = excluded.updated, "
+                                   "error = excluded.error",
+                                   [(s, uid, f, state.value, now, error) for s, f, uid in series])
+
+    def mark_forms(self, statuses: dict, form_paths: dict) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO forms (date_id, form_path, state, updated) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   [(int(d), form_paths.get(d), status.value, now)
+                                    for d, status in statuses.items()])
+
+    def forms_to_retry(self) -> dict:
+        # DateID -> FormPath of the reports that were missing or could not be written
+        states = (FormStatus.MISSING.value, FormStatus.FAILED.value)
+        with self._lock:
+            return dict(self._conn.execute("SELECT date_id, form_path FROM forms "
+                                           f"WHERE state IN ({','.join('?' * len(states))})",
+                                           states))
+
+    def close(self) -> None:
+        self._conn.close()
+
+def mark_converted(manifest: ProcessingManifest, fingerprints: dict, result: ConversionResult) -> None:
+    # Series that fail for reasons outside their files stay pending so that
+    # the next run retries them, the others are not tried again until they change
+    if result.status in (ConversionStatus.OK, ConversionStatus.SKIPPED, ConversionStatus.DUPLICATE):
+        manifest.mark(result.series_dir, fingerprints[result.series_dir], SeriesState.DONE)
+    elif result.permanent:
+        manifest.mark(result.series_dir, fingerprints[result.series_dir], SeriesState.FAILED,
+                      error=result.error)
@@ -0,0 +1,163 @@
+import os
+import uuid
+import datetime
+import pandas as pd
+from enum import Enum
+from typing import Union
+from src.sharding import shard_file
+from src.extract_metadata import METADATA_DTYPES
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+class MetadataFormat(Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+
+METADATA_FILES = {MetadataFormat.CSV: 'metadata.csv',
+                  MetadataFormat.PARQUET: 'metadata'}
+
+PARTITION_COLUMNS = ['StudyYear', 'StudyMonth']
+
+FLOAT_COLUMNS = ['RepetitionTime', 'EchoTime', 'InversionTime', 'MagneticFieldStrength',
+                 'SpacingBetweenSlices', 'SliceThickness']
+INT_COLUMNS = ['SamplesPerPixel', 'Rows', 'Columns', 'BitsAllocated', 'BitsStored',
+               'HighBit', 'PixelRepresentation', 'DateID']
+LIST_COLUMNS = ['PixelSpacing', 'ImageOrientationPatient']
+DATE_COLUMNS = ['StudyDate']
+
+# Read back the dtypes the frame had when it was written. Everything else stays
+# text, so identifiers such as '00123' keep their leading zeros.
+STORED_DTYPES = dict(METADATA_DTYPES, DateID='Int64')
+
+def metadata_path(output_directory: str, fmt: MetadataFormat, shard: Union[tuple, None] = None) -> str:
+    return os.path.join(output_directory, shard_file(METADATA_FILES[fmt], shard))
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError('pyarrow is required for the parquet metadata format')
+
+def _float_list(value) -> Union[list, None]:
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    return [float(v) for v in value]
+
+def to_arrow_table(df: pd.DataFrame) -> 'pa.Table':
+    _require_pyarrow()
+    df = df.copy()
+    for c in FLOAT_COLUMNS:
+        if c in df:
+            df[c] = pd.to_numeric(df[c], errors='coerce').astype('float64')
+    for c in INT_COLUMNS:
+        if c in df:
+            df[c] = pd.to_numeric(df[c], errors='coerce').astype('Int64')
+    for c in LIST_COLUMNS:
+        if c in df:
+            df[c] = df[c].apply(_float_list)
+    for c in DATE_COLUMNS:
+        if c in df:
+            df[c] = pd.to_datetime(df[c], errors='coerce')
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype(object).where(df[c].notna(), None)
+        if df[c].dtype == object and c not in LIST_COLUMNS:
+            df[c] = df[c].apply(lambda x: None if x is None else str(x)).astype('string')
+    df['StudyYear'] = df['StudyDate'].dt.year.astype('Int64')
+    df['StudyMonth'] = df['StudyDate'].dt.month.astype('Int64')
+    df['ProcessedAt'] = pd.Timestamp(datetime.datetime.now())
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def append_parquet(df: pd.DataFrame, dataset_dir: str) -> None:
+    # Every run adds its own files, existing row groups are never rewritten
+    pq.write_to_dataset(to_arrow_table(df),
+                        root_path=dataset_dir,
+                        partition_cols=PARTITION_COLUMNS,
+                        basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet')
+
+def read_parquet(dataset_dir: str,
+                 columns: Union[list, None] = None,
+                 filter=None) -> pd.DataFrame:
+    _require_pyarrow()
+    if not os.path.exists(dataset_dir):
+        return pd.DataFrame(columns=columns)
+    dataset = pds.dataset(dataset_dir, format='parquet', partitioning='hive')
+    # The schema is taken from one file; files written before a column existed
+    # would hide it, so the schemas of all files are merged
+    schema = pa.unify_schemas([dataset.schema] + [f.physical_schema for f in dataset.get_fragments()])
+    dataset = pds.dataset(dataset_dir, schema=schema, format='parquet', partitioning='hive')
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(list(columns) + ['OriginalSeriesDir', 'ProcessedAt']))
+    df = dataset.to_table(columns=read_columns, filter=filter).to_pandas()
+    # Series processed again in later runs were appended, keep their latest row
+    df = df.sort_values('ProcessedAt') \
+           .drop_duplicates(subset='OriginalSeriesDir', keep='last') \
+           .sort_index()
+    return df[columns] if columns is not None else df
+
+def coerce_stored(df: pd.DataFrame) -> pd.DataFrame:
+    for c, dtype in STORED_DTYPES.items():
+        if c not in df:
+            continue
+        if dtype == 'category':
+            df[c] = df[c].astype(object).where(df[c].notna(), None).astype(dtype)
+        elif dtype.startswith('datetime'):
+            df[c] = pd.to_datetime(df[c], errors='coerce')
+        else:
+            df[c] = pd.to_numeric(df[c], errors='coerce').astype(dtype)
+    return df
+
+def load_metadata(path: str,
+                  fmt: MetadataFormat = MetadataFormat.CSV,
+                  columns: Union[list, None] = None) -> pd.DataFrame:
+    if fmt == MetadataFormat.PARQUET:
+        return coerce_stored(read_parquet(path, columns))
+    if os.path.exists(path):
+        return coerce_stored(pd.read_csv(path, usecols=columns, dtype=str))
+    return pd.DataFrame(columns=columns)
+
+def merge_metadata(df_old: pd.DataFrame, df_new: pd.DataFrame, replaced_series: list) -> pd.DataFrame:
+    if df_old.empty:
+        return df_new
+    df_old = df_old[~df_old['OriginalSeriesDir'].isin(replaced_series)]
+    return pd.concat([df_old, df_new], ignore_index=True)
+
+def begin_metadata(path: str,
+                   fmt: MetadataFormat = MetadataFormat.CSV,
+                   replaced_series: Union[list, None] = None) -> None:
+    # Prepares the output for append_metadata: the csv loses the rows of the
+    # series that are going to be processed again. The parquet dataset resolves
+    # them at read time.
+    if fmt == MetadataFormat.CSV and os.path.exists(path) and replaced_series:
+        df_old = load_metadata(path, fmt)
+        df_old[~df_old['OriginalSeriesDir'].isin(replaced_series)].to_csv(path, index=False)
+
+def append_metadata(df: pd.DataFrame,
+                    path: str,
+                    fmt: MetadataFormat = MetadataFormat.CSV) -> None:
+    if fmt == MetadataFormat.PARQUET:
+        append_parquet(df, path)
+    elif not os.path.exists(path):
+        df.to_csv(path, index=False)
+    else:
+        # Rows are appended in the column order of the existing header. A file
+        # written before some column existed is rewritten once with all of them.
+        header = list(pd.read_csv(path, nrows=0).columns)
+        if set(df.columns) <= set(header):
+            df.reindex(columns=header).to_csv(path, mode='a', header=False, index=False)
+        else:
+            pd.concat([load_metadata(path, fmt), df], ignore_index=True).to_csv(path, index=False)
+
+def save_metadata(df: pd.DataFrame,
+                  path: str,
+                  fmt: MetadataFormat = MetadataFormat.CSV,
+                  replaced_series: Union[list, None] = None) -> None:
+    if fmt == MetadataFormat.PARQUET:
+        append_parquet(df, path)
+    else:
+        df_old = load_metadata(path, fmt)
+        merge_metadata(df_old, df, replaced_series or list()).to_csv(path, index=False)
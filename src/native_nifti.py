@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import nibabel as nib
+import pydicom
+from typing import Union
+from src.nifti_output import reorient_las
+
+# Relative tolerance for orientations, slice direction and slice spacing
+TOLERANCE = 1e-3
+
+class NotSimpleSeries(Exception):
+    pass
+
+def _dicom_files(series_dir: str) -> list:
+    with os.scandir(series_dir) as it:
+        return [e.path for e in it if e.name.endswith('.dcm') and e.is_file()]
+
+def _check(condition: bool, reason: str) -> None:
+    if not condition:
+        raise NotSimpleSeries(reason)
+
+def _rescale(slices: list) -> tuple:
+    slopes = {float(getattr(ds, 'RescaleSlope', 1) or 1) for ds in slices}
+    intercepts = {float(getattr(ds, 'RescaleIntercept', 0) or 0) for ds in slices}
+    _check(len(slopes) == 1 and len(intercepts) == 1, 'rescale varies between slices')
+    return slopes.pop(), intercepts.pop()
+
+def native_series_to_image(series_dir: str,
+                           iop: Union[list, None] = None,
+                           pixel_spacing: Union[list, None] = None) -> nib.Nifti1Image:
+    # Converts a single-frame, single-orientation 3D stack. Raises NotSimpleSeries
+    # for anything else (multi-frame, mosaic, gantry tilt, 4D, missing slices) so
+    # the caller can fall back to dicom2nifti.
+    files = _dicom_files(series_dir)
+    _check(len(files) > 1, 'less than two slices')
+    slices = [pydicom.dcmread(f) for f in files]
+    first = slices[0]
+
+    iop = np.array(iop if iop is not None else first.ImageOrientationPatient, dtype=float)
+    pixel_spacing = np.array(pixel_spacing if pixel_spacing is not None else first.PixelSpacing, dtype=float)
+    _check(iop.shape == (6,) and pixel_spacing.shape == (2,), 'missing geometry')
+    rows, columns = int(first.Rows), int(first.Columns)
+    for ds in slices:
+        _check(int(getattr(ds, 'NumberOfFrames', 1) or 1) == 1, 'multi-frame')
+        _check('MOSAIC' not in [str(t).upper() for t in getattr(ds, 'ImageType', [])], 'mosaic')
+        _check(int(ds.SamplesPerPixel) == 1, 'color image')
+        _check(int(ds.Rows) == rows and int(ds.Columns) == columns, 'slice size varies')
+        _check(np.allclose(np.array(ds.ImageOrientationPatient, dtype=float), iop, atol=TOLERANCE),
+               'orientation varies')
+        _check(np.allclose(np.array(ds.PixelSpacing, dtype=float), pixel_spacing, atol=TOLERANCE),
+               'pixel spacing varies')
+
+    row_cosine, column_cosine = iop[:3], iop[3:]
+    normal = np.cross(row_cosine, column_cosine)
+    positions = np.array([ds.ImagePositionPatient for ds in slices], dtype=float)
+    order = np.argsort(positions @ normal)
+    positions = positions[order]
+    slices = [slices[i] for i in order]
+
+    steps = np.diff(positions, axis=0)
+    distances = np.linalg.norm(steps, axis=1)
+    _check(np.all(distances > TOLERANCE), 'repeated slice positions (4D series)')
+    _check(np.allclose(distances, distances[0], rtol=TOLERANCE * 10), 'uneven slice spacing')
+    direction = steps[0] / distances[0]
+    _check(np.linalg.norm(np.cross(direction, normal)) < TOLERANCE * 10, 'gantry tilt')
+
+    slope, intercept = _rescale(slices)
+    dtype = first.pixel_array.dtype if (slope, intercept) == (1.0, 0.0) else np.float32
+    data = np.empty((columns, rows, len(slices)), dtype=dtype)
+    for k, ds in enumerate(slices):
+        # pixel_array is indexed [row, column], NIfTI voxels [i=column, j=row, k=slice]
+        data[:, :, k] = ds.pixel_array.T
+    if dtype == np.float32:
+        data *= slope
+        data += intercept
+
+    # DICOM geometry is LPS, NIfTI expects RAS
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosine * pixel_spacing[1]
+    affine[:3, 1] = column_cosine * pixel_spacing[0]
+    affine[:3, 2] = (positions[-1] - positions[0]) / (len(slices) - 1)
+    affine[:3, 3] = positions[0]
+    affine[:2, :] *= -1
+
+    # Same voxel layout as dicom2nifti with reorient_nifti, whichever converter ran
+    return reorient_las(nib.Nifti1Image(data, affine))
@@ -0,0 +1,114 @@
+import os
+import gzip
+import zlib
+import struct
+import uuid
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from dicom2nifti.image_volume import ImageVolume
+
+class NiftiFormat(Enum):
+    NII = "nii"
+    NII_GZ = "nii.gz"
+
+NIFTI_SUFFIXES = {NiftiFormat.NII: '.nii',
+                  NiftiFormat.NII_GZ: '.nii.gz'}
+
+# nibabel's own level, what dicom2nifti used to write
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# Input bytes compressed by each thread; every block is primed with the 32 KiB
+# before it, so the ratio is close to single-threaded gzip
+GZIP_BLOCK_SIZE = 1024 ** 2
+GZIP_WINDOW = 32 * 1024
+
+def reorient_las(img: nib.Nifti1Image) -> nib.Nifti1Image:
+    # dicom2nifti's reorient_nifti step (image_reorientation.reorient_image):
+    # voxel axes sagittal, coronal, axial, stored LAS. Done in memory, the
+    # dicom2nifti function always writes the image to a file.
+    image = ImageVolume(img)
+    sagittal = image.sagittal_orientation.normal_component
+    coronal = image.coronal_orientation.normal_component
+    axial = image.axial_orientation.normal_component
+    data = np.moveaxis(image.nifti_data, [sagittal, coronal, axial], [0, 1, 2])
+    affine = np.eye(4)
+    affine[:, 0] = image.affine[:, sagittal]
+    affine[:, 1] = image.affine[:, coronal]
+    affine[:, 2] = image.affine[:, axial]
+    origin = [0, 0, 0, 1]
+    if not image.axial_orientation.x_inverted:
+        data = np.flip(data, axis=0)
+        affine[:, 0] = -affine[:, 0]
+        origin[sagittal] = image.dimensions[sagittal] - 1
+    if image.axial_orientation.y_inverted:
+        data = np.flip(data, axis=1)
+        affine[:, 1] = -affine[:, 1]
+        origin[coronal] = image.dimensions[coronal] - 1
+    if image.sagittal_orientation.y_inverted:
+        data = np.flip(data, axis=2)
+    if image.coronal_orientation.y_inverted:
+        affine[:, 2] = -affine[:, 2]
+        origin[axial] = image.dimensions[axial] - 1
+    affine[:, 3] = np.dot(image.affine, origin)
+    if data.ndim > 3:
+        data = data.squeeze()
+    output = nib.Nifti1Image(data, affine)
+    output.header.set_slope_inter(1, 0)
+    output.header.set_xyzt_units(2)
+    return output
+
+def _deflate_block(data: memoryview, start: int, level: int) -> bytes:
+    end = min(start + GZIP_BLOCK_SIZE, len(data))
+    if start > 0:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=data[max(0, start - GZIP_WINDOW): start])
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # Sync flush ends every block on a byte boundary so the blocks can be concatenated
+    last = end == len(data)
+    return compressor.compress(data[start: end]) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def write_parallel_gzip(data: bytes, f, level: int = DEFAULT_COMPRESSION_LEVEL, threads: int = 1) -> None:
+    # One gzip member whose deflate stream is compressed block by block in
+    # threads (zlib releases the GIL), the same scheme as pigz. Blocks are
+    # written as they finish, at most a few of them are held compressed.
+    view = memoryview(data)
+    f.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        crc = executor.submit(zlib.crc32, view)
+        pending = list()
+        for start in range(0, max(len(data), 1), GZIP_BLOCK_SIZE):
+            if len(pending) >= 2 * threads:
+                f.write(pending.pop(0).result())
+            pending.append(executor.submit(_deflate_block, view, start, level))
+        for block in pending:
+            f.write(block.result())
+        f.write(struct.pack('<II', crc.result(), len(data) & 0xffffffff))
+
+def save_nifti(img: nib.Nifti1Image,
+               path: str,
+               compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+               compression_threads: int = 1) -> None:
+    # The format follows the suffix of path. Written to a temporary file first
+    # so an interrupted conversion never leaves a truncated NIfTI behind. The
+    # image is streamed to the file, only multi-threaded compression needs it
+    # serialized in memory.
+    # Unique, two series with the same SeriesInstanceUID may be written at once
+    tmp = f'{path}.{uuid.uuid4().hex[:8]}.part'
+    try:
+        with open(tmp, 'wb') as f:
+            if not path.endswith('.gz'):
+                img.to_stream(f)
+            elif compression_threads > 1:
+                write_parallel_gzip(img.to_bytes(), f, compression_level, compression_threads)
+            else:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                                   compresslevel=compression_level, mtime=0) as gz:
+                    img.to_stream(gz)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,32 @@
+import os
+import logging
+import pandas as pd
+from src.nifti_output import NiftiFormat, NIFTI_SUFFIXES
+
+def _str(column: pd.Series) -> pd.Series:
+    # str() of every value, as with object columns (nullable ints give '<NA>', not 'nan')
+    return column.astype(object).map(str)
+
+def add_output_paths(df: pd.DataFrame,
+                     output_directory: str,
+                     nifti_format: NiftiFormat = NiftiFormat.NII_GZ) -> None:
+    # Built column-wise, <output>/<PatientID>/<YYYY-MM-DD>/... A missing or
+    # unreadable StudyDate gives a 'NaT' directory, as str() of the date did.
+    study_dates = pd.to_datetime(df['StudyDate'], errors='coerce').dt.strftime('%Y-%m-%d')
+    study_dirs = os.path.join(output_directory, '') \
+                 + _str(df['PatientID']) + os.sep \
+                 + study_dates.fillna('NaT') + os.sep
+
+    df['NiftiPath'] = study_dirs + _str(df['StudyInstanceUID']) + os.sep \
+                      + _str(df['SeriesInstanceUID']) + NIFTI_SUFFIXES[nifti_format]
+
+    df['FormPath'] = study_dirs + 'Report' + os.sep + _str(df['DateID']) + '.txt'
+
+def create_directory_structure(df: pd.DataFrame) -> None:
+    # Series of a study share their directory, each one is created once
+    paths = pd.concat([df['NiftiPath'], df['FormPath']]).dropna().unique()
+    for directory in sorted({os.path.dirname(p) for p in paths}):
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as err:
+            logging.error(f'ERROR CREATING DIRECTORY {directory}; ERROR {err}')
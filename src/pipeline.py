@@ -0,0 +1,239 @@
+import logging
+import os
+import queue
+import threading
+import re
+import pandas as pd
+from functools import partial
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Union
+from db.db_access import DatabaseAccess
+from db.id_date_cache import IdDateCache
+from src.convert_to_nifti import (ConversionResult, ConversionStatus, DEFAULT_MAX_INFLIGHT_BYTES,
+                                  iter_conversions, conversion_options, is_duplicate,
+                                  remove_stale_outputs, no_output_path)
+from src.dedup import DuplicateIndex, mark_duplicates
+from src.extract_forms import extract_forms, form_paths, DEFAULT_ANONYMIZATION_PATTERN
+from src.extract_metadata import (metadata_frame, extract_series_metadata, assign_patient_ids,
+                                  assign_date_ids)
+from src.manifest import ProcessingManifest, SeriesState, mark_converted
+from src.metadata_store import MetadataFormat, begin_metadata, append_metadata
+from src.pseudonyms import PseudonymIndex
+from src.paths import add_output_paths, create_directory_structure
+from src.nifti_output import NiftiFormat, DEFAULT_COMPRESSION_LEVEL
+from src.instrumentation import RunMetrics
+from src.process_pool import ProcessPool
+
+# Marks the end of a stream in the queues connecting the stages
+_END = object()
+
+# Seconds a partially filled batch waits for more series before being flushed
+BATCH_TIMEOUT = 1.0
+
+@dataclass
+class PipelineConfig:
+    output_directory: str
+    metadata_file: str
+    metadata_format: MetadataFormat = MetadataFormat.CSV
+    scan_workers: int = 1
+    form_workers: int = 1
+    anonymize_workers: int = 1
+    anonymization_pattern: re.Pattern = DEFAULT_ANONYMIZATION_PATTERN
+    workers: int = 1
+    max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES
+    native: bool = False
+    nifti_format: NiftiFormat = NiftiFormat.NII_GZ
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL
+    compression_threads: int = 1
+    batch_size: int = 100
+    buffer_size: int = 1000
+
+def _start(target: Callable, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+def _feed(items: list, outbox: queue.Queue) -> None:
+    try:
+        for item in items:
+            outbox.put(item)
+    finally:
+        outbox.put(_END)
+
+def _map_stage(func: Callable, inbox: queue.Queue, outbox: queue.Queue, workers: int) -> list:
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def run():
+        try:
+            while True:
+                item = inbox.get()
+                if item is _END:
+                    inbox.put(_END)  # Let the sibling workers see the end too
+                    break
+                try:
+                    result = func(item)
+                except Exception as err:
+                    logging.error(f'PIPELINE ERROR PROCESSING {item}; ERROR {err}')
+                    continue
+                if result is not None:
+                    outbox.put(result)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                outbox.put(_END)
+
+    return [_start(run) for _ in range(workers)]
+
+def _batches(inbox: queue.Queue, batch_size: int):
+    batch = list()
+    while True:
+        try:
+            item = inbox.get(timeout=BATCH_TIMEOUT) if batch else inbox.get()
+        except queue.Empty:
+            yield batch
+            batch = list()
+            continue
+        if item is _END:
+            if batch:
+                yield batch
+            return
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+
+def _batch_stage(func: Callable, inbox: queue.Queue, outbox: queue.Queue, batch_size: int) -> threading.Thread:
+    def run():
+        try:
+            for batch in _batches(inbox, batch_size):
+                try:
+                    func(batch, outbox)
+                except Exception as err:
+                    logging.error(f'PIPELINE ERROR PROCESSING BATCH OF {len(batch)} SERIES; ERROR {err}')
+        finally:
+            outbox.put(_END)
+
+    return _start(run)
+
+def run_pipeline(series: list,
+                 config: PipelineConfig,
+                 irix_access: DatabaseAccess,
+                 forms_access: DatabaseAccess,
+                 manifest: ProcessingManifest,
+                 fingerprints: dict,
+                 id_date_cache: Union[IdDateCache, None] = None,
+                 pseudonyms: Union[PseudonymIndex, None] = None,
+                 metrics: Union[RunMetrics, None] = None,
+                 executor: Union[Executor, None] = None,
+                 anonymizer: Union[Executor, None] = None,
+                 duplicates: Union[DuplicateIndex, None] = None,
+                 changed: Union[set, None] = None) -> Counter:
+    # Series flow through scan -> DateID resolution and paths -> reports -> conversion.
+    # Every stage runs at the same time and the bounded queues between them keep
+    # memory flat whatever the size of the archive.
+    pseudonyms = pseudonyms if pseudonyms is not None else PseudonymIndex()
+    duplicates = duplicates if duplicates is not None else DuplicateIndex()
+    # Series modified since they were processed, their outputs are replaced
+    changed = changed if changed is not None else set(manifest.changed(fingerprints))
+    counts = Counter()
+    q_series = queue.Queue(maxsize=config.buffer_size)
+    q_rows = queue.Queue(maxsize=config.buffer_size)
+    q_batches = queue.Queue(maxsize=max(1, config.buffer_size // config.batch_size))
+    q_convert = queue.Queue(maxsize=config.buffer_size)
+
+    begin_metadata(config.metadata_file, config.metadata_format, replaced_series=series)
+
+    def resolve(rows: list, outbox: queue.Queue) -> None:
+        df = metadata_frame(rows)
+        assign_patient_ids(df, pseudonyms)
+        assign_date_ids(df, irix_access, id_date_cache)
+        mark_duplicates(df, duplicates, max(1, config.scan_workers))
+        add_output_paths(df, config.output_directory, config.nifti_format)
+        remove_stale_outputs(df, changed)
+        create_directory_structure(df)
+        append_metadata(df, config.metadata_file, config.metadata_format)
+        manifest.mark_many([(s, fingerprints[s], u) for s, u in zip(df['OriginalSeriesDir'],
+                                                                    df['SeriesInstanceUID'])],
+                           SeriesState.SCANNED)
+        counts['scanned'] += len(df)
+        if metrics is not None:
+            metrics.count('series_scanned', len(df))
+        outbox.put(df)
+
+    def report(batches: list, outbox: queue.Queue) -> None:
+        for df in batches:
+            try:
+                statuses = extract_forms(df, forms_access,
+                                         workers=config.form_workers,
+                                         pattern=config.anonymization_pattern,
+                                         anonymizer=anonymizer,
+                                         refresh=set(df.loc[df['OriginalSeriesDir'].isin(changed), 'DateID']))
+                manifest.mark_forms(statuses, form_paths(df))
+                for status in statuses.values():
+                    counts['forms_' + status.value] += 1
+                if metrics is not None:
+                    metrics.record_forms(statuses)
+            except Exception as err:
+                logging.error(f'ERROR WHILE EXTRACTING FORMS; ERROR {err}')
+            # Series go on to conversion even when their report failed
+            for row in df.to_dict('records'):
+                outbox.put((row['OriginalSeriesDir'], row['NiftiPath'],
+                            conversion_options(row, config.native, config.compression_level,
+                                               config.compression_threads),
+                            is_duplicate(row)))
+
+    def on_result(result: ConversionResult) -> None:
+        counts[result.status.value] += 1
+        if metrics is not None:
+            metrics.record_conversion(result)
+        if result.status == ConversionStatus.FAILED:
+            logging.error(f'DICOM-TO-NIFIT ERROR IN SERIE {result.series_dir}; ERROR {result.error}')
+        elif result.status == ConversionStatus.REJECTED:
+            logging.warning(f'Serie {result.series_dir} not converted: {result.error}')
+        mark_converted(manifest, fingerprints, result)
+
+    def jobs():
+        while True:
+            item = q_convert.get()
+            if item is _END:
+                return
+            s_org, s_des, options, duplicate = item
+            if duplicate:
+                on_result(ConversionResult(s_org, s_des, ConversionStatus.DUPLICATE))
+            elif pd.isna(s_des):
+                on_result(no_output_path(s_org, s_des))
+            elif os.path.exists(s_des):
+                on_result(ConversionResult(s_org, s_des, ConversionStatus.SKIPPED))
+            else:
+                yield s_org, s_org, s_des, options
+
+    # Pools passed in by the caller (watch mode) are reused and left running
+    own_anonymizer = anonymizer is None and config.anonymize_workers > 1
+    if own_anonymizer:
+        anonymizer = ProcessPoolExecutor(max_workers=config.anonymize_workers)
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPool(max_workers=max(1, config.workers))
+
+    threads = [_start(_feed, series, q_series)]
+    threads += _map_stage(partial(extract_series_metadata, metrics=metrics), q_series, q_rows, max(1, config.scan_workers))
+    threads.append(_batch_stage(resolve, q_rows, q_batches, config.batch_size))
+    threads.append(_batch_stage(report, q_batches, q_convert, 1))
+
+    try:
+        for _, result in iter_conversions(jobs(), executor, max(1, config.workers),
+                                          config.max_inflight_bytes):
+            on_result(result)
+        for thread in threads:
+            thread.join()
+    finally:
+        if own_executor:
+            executor.shutdown()
+        if own_anonymizer:
+            anonymizer.shutdown()
+    return counts
@@ -0,0 +1,81 @@
+import os
+import logging
+import numpy as np
+import pydicom
+import dicom2nifti
+from typing import Union
+
+# dicom2nifti refuses volumes of 3 slices or less (TOO_FEW_SLICES/LOCALIZER)
+MIN_SLICES = 4
+ORIENTATION_TOLERANCE = 1e-3
+
+PREFLIGHT_TAGS = [0x00080008,  # ImageType
+                  0x0020000E,  # SeriesInstanceUID
+                  0x00200013,  # InstanceNumber
+                  0x00200032,  # ImagePositionPatient
+                  0x00200037,  # ImageOrientationPatient
+                  0x00280008]  # NumberOfFrames
+
+def _image_type(ds: pydicom.Dataset) -> list:
+    return [str(t).upper() for t in (ds.get('ImageType') or [])]
+
+def _is_imaging_slice(ds: pydicom.Dataset) -> bool:
+    # Same test as dicom2nifti's is_valid_imaging_dicom for single-frame files
+    return 'SeriesInstanceUID' in ds and 'InstanceNumber' in ds \
+           and len(ds.get('ImageOrientationPatient') or []) >= 6 \
+           and len(ds.get('ImagePositionPatient') or []) >= 3
+
+def _orientation_groups(slices: list) -> list:
+    groups = list()
+    for ds in slices:
+        iop = np.array(ds.ImageOrientationPatient[:6], dtype=float)
+        for group in groups:
+            if np.allclose(iop, group[0], atol=ORIENTATION_TOLERANCE):
+                group[1] += 1
+                break
+        else:
+            groups.append([iop, 1])
+    return [count for _, count in groups]
+
+def preflight_series(series_dir: str) -> Union[str, None]:
+    # Reason why dicom2nifti is certain to fail on the series, from the headers
+    # of its files only, or None. Multi-frame and mosaic series go through
+    # vendor specific code and are always let through.
+    try:
+        with os.scandir(series_dir) as it:
+            files = [e.path for e in it if e.name.endswith('.dcm') and e.is_file()]
+    except OSError as err:
+        return f'cannot list series: {err}'
+    if not files:
+        return 'no DICOM files'
+
+    headers = list()
+    for f in files:
+        try:
+            headers.append(pydicom.dcmread(f, stop_before_pixels=True, specific_tags=PREFLIGHT_TAGS))
+        except Exception as err:
+            logging.debug(f'PREFLIGHT CANNOT READ {f}: {err}')
+    if not headers:
+        return 'no readable DICOM files'
+    for ds in headers:
+        if int(ds.get('NumberOfFrames') or 1) > 1 or 'MOSAIC' in _image_type(ds):
+            return None
+
+    imaging = [ds for ds in headers if _is_imaging_slice(ds)]
+    slices = [ds for ds in imaging if 'LOCALIZER' not in _image_type(ds)]
+    if not slices:
+        return 'localizer' if imaging else 'no imaging slices'
+    if not dicom2nifti.settings.validate_slicecount:
+        return None
+    if len(slices) < MIN_SLICES:
+        return f'too few slices ({len(slices)})'
+
+    # dicom2nifti drops orientations with less than 4 slices as localizers
+    groups = _orientation_groups(slices)
+    if len(groups) > 1:
+        groups = [count for count in groups if count >= MIN_SLICES]
+        if sum(groups) < MIN_SLICES:
+            return 'too few slices after removing localizers'
+        if len(groups) > 1 and dicom2nifti.settings.validate_orientation:
+            return 'inconsistent image orientation'
+    return None
@@ -0,0 +1,44 @@
+import logging
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+class ProcessPool(Executor):
+    # ProcessPoolExecutor that can be replaced once broken. A worker that dies
+    # (e.g. killed by the OOM killer on a large series) breaks the whole pool:
+    # the jobs in flight and every later submit fail with BrokenProcessPool
+    # until restart() starts a new pool.
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.broken = False
+        self._lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def _check(self, executor: ProcessPoolExecutor, future: Future) -> None:
+        # Futures of a pool that was already replaced do not mark the new one
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            with self._lock:
+                if executor is self._executor:
+                    self.broken = True
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        with self._lock:
+            executor = self._executor
+            try:
+                future = executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self.broken = True
+                raise
+        future.add_done_callback(partial(self._check, executor))
+        return future
+
+    def restart(self) -> None:
+        with self._lock:
+            logging.error('PROCESS POOL BROKEN, A WORKER DIED; STARTING A NEW POOL')
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            self.broken = False
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,114 @@
+import sqlite3
+import logging
+import threading
+from typing import Union
+
+PREFIX = 'Sub-'
+LOCK_TIMEOUT = 60.0
+QUERY_CHUNK = 500
+INSERT_ATTEMPTS = 5
+
+class PseudonymIndex:
+    # Persistent OriginalPatientId -> PatientID ('Sub-<n>') index shared by every
+    # run and shard writing to the same output directory. Subjects are only ever
+    # appended, so a patient keeps its subject across runs and lookups of known
+    # patients are answered from memory.
+    def __init__(self, path: Union[str, None] = None):
+        self.path = path
+        self._cache = dict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path or ':memory:',
+                                     timeout=LOCK_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS subjects ("
+                           "original_id TEXT PRIMARY KEY, "
+                           "number INTEGER UNIQUE NOT NULL)")
+
+    @staticmethod
+    def _key(original_id) -> str:
+        return '' if original_id is None else str(original_id)
+
+    def _lookup(self, keys: list) -> None:
+        for s in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[s: s + QUERY_CHUNK]
+            rows = self._conn.execute("SELECT original_id, number FROM subjects "
+                                      f"WHERE original_id IN ({','.join('?' * len(chunk))})",
+                                      chunk)
+            self._cache.update((k, PREFIX + str(n)) for k, n in rows)
+
+    def _insert(self, keys: list) -> None:
+        # BEGIN IMMEDIATE takes the write lock, other processes wait for it
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._lookup(keys)
+            new = sorted(k for k in keys if k not in self._cache)
+            first = self._conn.execute("SELECT COALESCE(MAX(number), -1) + 1 FROM subjects").fetchone()[0]
+            numbers = dict(zip(new, range(first, first + len(new))))
+            self._conn.executemany("INSERT INTO subjects VALUES (?, ?)",
+                                   [(k, numbers[k]) for k in new])
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._cache.update((k, PREFIX + str(numbers[k])) for k in new)
+
+    def _insert_retrying(self, keys: list) -> None:
+        for attempt in range(1, INSERT_ATTEMPTS + 1):
+            try:
+                self._insert(keys)
+                return
+            except sqlite3.IntegrityError as err:
+                # Another process assigned the same patient or number at the same
+                # time, e.g. on a filesystem whose locks SQLite cannot rely on. The
+                # next attempt looks the patients up again and takes new numbers.
+                if attempt == INSERT_ATTEMPTS:
+                    raise
+                logging.error(f'SUBJECT ASSIGNMENT CONFLICT ({err}), RETRYING {attempt}/{INSERT_ATTEMPTS - 1}')
+
+    def empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM subjects LIMIT 1").fetchone() is None
+
+    def seed(self, mapping: dict) -> None:
+        # Imports subjects assigned before the index existed, e.g. from metadata.csv
+        if not mapping:
+            return
+        numbers, owners = dict(), dict()
+        for o, p in mapping.items():
+            key = self._key(o)
+            try:
+                n = int(str(p)[len(PREFIX):]) if str(p).startswith(PREFIX) else None
+            except ValueError:
+                n = None
+            if n is None:
+                logging.error(f'INVALID PATIENTID {p} FOR PATIENT {key}, NOT IMPORTED')
+            elif n in owners:
+                # e.g. metadata patched by hand; the patient gets a new subject when seen again
+                logging.error(f'PATIENTID {p} OF PATIENT {key} ALREADY BELONGS TO PATIENT {owners[n]}, NOT IMPORTED')
+            else:
+                owners[n] = key
+                numbers[key] = n
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM subjects LIMIT 1").fetchone() is None:
+                    self._conn.executemany("INSERT INTO subjects VALUES (?, ?)", numbers.items())
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def assign(self, original_ids: list) -> dict:
+        keys = {self._key(o) for o in original_ids}
+        with self._lock:
+            missing = [k for k in keys if k not in self._cache]
+            if missing:
+                self._lookup(missing)
+                missing = [k for k in missing if k not in self._cache]
+            if missing:
+                self._insert_retrying(missing)
+            return {o: self._cache[self._key(o)] for o in set(original_ids)}
+
+    def close(self) -> None:
+        self._conn.close()
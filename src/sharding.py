@@ -0,0 +1,34 @@
+import os
+import hashlib
+from argparse import ArgumentTypeError
+from typing import Union
+
+def parse_shard(value: str) -> tuple:
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f'shard must be i/N, got {value}')
+    if count < 1 or not 0 <= index < count:
+        raise ArgumentTypeError(f'shard index must be in [0, {count}), got {value}')
+    return index, count
+
+def shard_suffix(shard: tuple) -> str:
+    index, count = shard
+    return f'shard-{index:03d}-of-{count:03d}'
+
+def shard_file(name: str, shard: Union[tuple, None]) -> str:
+    # Output files written by a single shard, e.g. metadata.shard-000-of-004.csv
+    if shard is None:
+        return name
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{shard_suffix(shard)}{ext}'
+
+def shard_of(series_dir: str, count: int) -> int:
+    # Hash of the study directory name: every series of a study goes to the
+    # same shard, whatever the node and the order glob returned
+    study = os.path.basename(os.path.dirname(os.path.normpath(series_dir)))
+    return int(hashlib.md5(study.encode('utf-8')).hexdigest(), 16) % count
+
+def select_shard(series: list, shard: tuple) -> list:
+    index, count = shard
+    return [s for s in series if shard_of(s, count) == index]
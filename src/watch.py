@@ -0,0 +1,181 @@
+import os
+import time
+import errno
+import logging
+from typing import Union
+from src.manifest import series_fingerprint
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+DEFAULT_SETTLE_SECONDS = 60.0
+DEFAULT_POLL_SECONDS = 10.0
+
+def _subdirectories(path: str) -> list:
+    try:
+        with os.scandir(path) as it:
+            return [e.path for e in it if e.is_dir()]
+    except OSError as err:
+        logging.error(err)
+        return list()
+
+def _mtime(path: str) -> Union[int, None]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class SeriesWatcher:
+    # Finds series directories (<input>/<study>/<series>) created or modified
+    # after the watcher started, including files added later to a series that
+    # already existed or was reported. A series is reported once nothing in it
+    # has changed for settle_seconds, i.e. once the archive finished writing it.
+    # Uses inotify when inotify_simple is installed and polls directory mtimes
+    # and series fingerprints otherwise, or when the inotify watch limit is hit.
+    def __init__(self,
+                 input_directory: str,
+                 settle_seconds: float = DEFAULT_SETTLE_SECONDS,
+                 poll_seconds: float = DEFAULT_POLL_SECONDS,
+                 use_inotify: bool = True):
+        self.input_directory = input_directory
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self._candidates = dict()  # series dir -> (fingerprint, time it last changed)
+        self._mtimes = dict()      # study dir -> mtime seen by the last poll
+        self._series = dict()      # series dir -> mtime seen by the last poll
+        self._watches = dict()     # inotify watch descriptor -> directory
+        self._descriptors = dict() # directory -> inotify watch descriptor
+        self._inotify = None
+        if use_inotify and inotify_simple is not None:
+            try:
+                self._inotify = inotify_simple.INotify()
+            except OSError as err:
+                logging.error(f'INOTIFY NOT AVAILABLE, POLLING {input_directory}; ERROR {err}')
+        if self._inotify is not None:
+            # Series directories are watched too, files may still arrive in them
+            self._watch(input_directory)
+            for study in _subdirectories(input_directory):
+                self._watch(study)
+                for series_dir in _subdirectories(study):
+                    self._watch(series_dir)
+        if self._inotify is None:
+            self._scan(initial=True)
+
+    @property
+    def mode(self) -> str:
+        return 'inotify' if self._inotify is not None else 'polling'
+
+    def _watch(self, directory: str) -> None:
+        if self._inotify is None or directory in self._descriptors:
+            return
+        flags = inotify_simple.flags
+        try:
+            wd = self._inotify.add_watch(directory, flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE
+                                         | flags.DELETE_SELF | flags.ONLYDIR)
+            self._watches[wd] = directory
+            self._descriptors[directory] = wd
+        except OSError as err:
+            if err.errno != errno.ENOSPC:
+                logging.error(f'CANNOT WATCH {directory}; ERROR {err}')
+                return
+            logging.error(f'INOTIFY WATCH LIMIT REACHED, POLLING {self.input_directory}; '
+                          'RAISE fs.inotify.max_user_watches TO USE INOTIFY')
+            self._inotify.close()
+            self._inotify = None
+            self._watches.clear()
+            self._descriptors.clear()
+
+    def _touch(self, series_dir: str) -> None:
+        # Restarts the settle timer of the series
+        self._candidates[series_dir] = (None, time.monotonic())
+
+    def _depth(self, path: str) -> int:
+        return len(os.path.relpath(path, self.input_directory).split(os.sep))
+
+    def _new_directory(self, path: str) -> None:
+        if self._depth(path) == 1:
+            # A study, its series may have been created before the watch was added
+            self._watch(path)
+            for series_dir in _subdirectories(path):
+                self._new_directory(series_dir)
+        elif self._depth(path) == 2:
+            self._watch(path)
+            self._touch(path)
+            if self._inotify is None:
+                # Watch limit reached, polling takes over from what is on disk now
+                self._scan(initial=True)
+
+    def _read_events(self) -> None:
+        flags = inotify_simple.flags
+        for event in self._inotify.read(timeout=int(self.poll_seconds * 1000)):
+            if self._inotify is None:
+                break
+            if event.mask & flags.Q_OVERFLOW:
+                logging.error('INOTIFY QUEUE OVERFLOW, RESCANNING INPUT DIRECTORY')
+                for study in _subdirectories(self.input_directory):
+                    self._new_directory(study)
+                continue
+            directory = self._watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & (flags.DELETE_SELF | flags.IGNORED):
+                self._watches.pop(event.wd, None)
+                self._descriptors.pop(directory, None)
+                self._candidates.pop(directory, None)
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                self._new_directory(path)
+            elif self._depth(directory) == 2:
+                self._touch(directory)
+
+    def _scan(self, initial: bool = False) -> None:
+        # Directory mtimes change when entries are added: studies whose mtime
+        # moved are listed again for new series, and every known series is
+        # checked for new files
+        for study in _subdirectories(self.input_directory):
+            mtime = _mtime(study)
+            if mtime == self._mtimes.get(study):
+                continue
+            self._mtimes[study] = mtime
+            for series_dir in _subdirectories(study):
+                self._series.setdefault(series_dir, None)
+        for series_dir, seen in list(self._series.items()):
+            mtime = _mtime(series_dir)
+            if mtime is None:
+                del self._series[series_dir]
+            elif mtime != seen:
+                self._series[series_dir] = mtime
+                if not initial:
+                    self._touch(series_dir)
+
+    def poll(self) -> list:
+        # Waits up to poll_seconds for changes and returns the series that settled
+        if self._inotify is not None:
+            self._read_events()
+        else:
+            time.sleep(self.poll_seconds)
+            self._scan()
+
+        now = time.monotonic()
+        settled = list()
+        for series_dir, (fingerprint, changed) in list(self._candidates.items()):
+            if not os.path.isdir(series_dir):
+                del self._candidates[series_dir]
+                continue
+            if self._inotify is None:
+                # Without events, writes to existing files only show in the fingerprint
+                current = series_fingerprint(series_dir)
+                if current != fingerprint:
+                    self._candidates[series_dir] = (current, now)
+                    continue
+            if now - changed >= self.settle_seconds:
+                settled.append(series_dir)
+                del self._candidates[series_dir]
+        return sorted(settled)
+
+    def close(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()